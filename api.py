@@ -0,0 +1,106 @@
+import json
+
+try:
+    import orjson
+except ImportError:  # the standard encoder, without whitespace
+    orjson = None
+
+from storage import sort_key
+
+# -------------------- JSON API --------------------
+# Read-only view of projects, expenses and progress for scripts. A request is
+# {"resource": ..., filters...}; a batch is a list of them answered together,
+# and every collection a batch touches is loaded and grouped once for all of
+# its requests. What a caller sees follows the dashboard: admins see every
+# project, everyone else the projects they are a member of.
+API_VERSION = 1
+RESOURCES = ("projects", "expenses", "progress")
+MAX_BATCH = 50
+DATED_ORDER = ("date", "id")
+
+
+def dumps(data):
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(",", ":")).encode("utf-8")
+
+
+def _flag(value):
+    if value is None or isinstance(value, bool):
+        return value
+    value = str(value).strip().lower()
+    if value in ("", "all"):
+        return None
+    if value in ("1", "true", "yes"):
+        return True
+    if value in ("0", "false", "no"):
+        return False
+    raise ValueError("completed must be true, false or all")
+
+
+def _ids(value):
+    # One project id, a list of them or a comma separated string
+    if value is None or value == "":
+        return None
+    if isinstance(value, str):
+        value = value.split(",")
+    elif not isinstance(value, list):
+        value = [value]
+    try:
+        return {int(v) for v in value}
+    except (TypeError, ValueError):
+        raise ValueError("project must be a project id or a list of them")
+
+
+class Batch:
+    def __init__(self, storage, by_project, projects, everything=False):
+        # projects: every project the caller may see; everything: the caller
+        # is an admin and sees rows of deleted projects as well
+        self.storage = storage
+        self.by_project = by_project
+        self.projects = {p["id"]: p for p in projects}
+        self.everything = everything
+        self.grouped = {}
+
+    def rows(self, name):
+        grouped = self.grouped.get(name)
+        if grouped is None:
+            rows = self.storage.all(name) if self.everything else self.by_project[name].get(*self.projects)
+            grouped = self.grouped[name] = {}
+            for row in rows:
+                grouped.setdefault(row.get("project_id"), []).append(row)
+            for group in grouped.values():
+                group.sort(key=lambda r: sort_key(r, DATED_ORDER), reverse=True)
+        return grouped
+
+    def run(self, item):
+        if not isinstance(item, dict):
+            raise ValueError("a request must be a JSON object")
+        resource = item.get("resource")
+        if resource not in RESOURCES:
+            raise ValueError(f"resource must be one of {', '.join(RESOURCES)}")
+        ids = _ids(item.get("project"))
+        if resource != "projects":
+            grouped = self.rows(resource)
+            keys = grouped if ids is None else [i for i in ids if i in self.projects or self.everything]
+            rows = [r for key in keys for r in grouped.get(key, [])]
+            rows.sort(key=lambda r: sort_key(r, DATED_ORDER), reverse=True)
+            return {"resource": resource, "items": rows}
+        completed = _flag(item.get("completed"))
+        include = item.get("include") or []
+        if isinstance(include, str):
+            include = [i for i in include.split(",") if i]
+        if any(i not in ("expenses", "progress") for i in include):
+            raise ValueError("include takes expenses and progress")
+        projects = []
+        for project in self.projects.values():
+            if ids is not None and project["id"] not in ids:
+                continue
+            if completed is not None and (project.get("status") == "completed") != completed:
+                continue
+            project = dict(project)
+            for name in include:
+                project[name] = self.rows(name).get(project["id"], [])
+            projects.append(project)
+        projects.sort(key=lambda p: p["id"])
+        return {"resource": "projects", "items": projects}
@@ -1,44 +1,113 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash
+from flask import Blueprint, Flask, current_app, render_template, request, redirect, url_for, session, flash, make_response, abort, Response
+from markupsafe import Markup
+from werkzeug.local import LocalProxy
+import base64
+import gc
+import hashlib
+import io
 import json
+import math
 import os
+from contextlib import contextmanager
 from functools import wraps
 from datetime import datetime
 
+import click
+
+from api import API_VERSION, MAX_BATCH, Batch, dumps
+from archive import MESSAGE_ORDER, MessageArchive, pair_key
+from fragments import FragmentCache
+from indexes import (
+    Accounts, Conversations, ExpensesByProject, Inbox, MiscByMonth, MiscByUser, MiscSummary, ProgressByProject, ProjectsByUser,
+    UnreadIndex, message_preview,
+)
+from notify import Notifier
+from reports import DIMENSIONS, Reports
+from search import ARCHIVE_SOURCE, SEARCH_FIELDS, SEARCH_ORDER, TextIndex, search_rows
+from storage import (
+    COLLECTIONS, DEFAULTS, FILE_FORMATS, LOG_COLLECTIONS, JsonStorage, matches, open_storage, page_rows, primary_key,
+    read_cache, sort_key,
+)
+from transfer import FORMATS, TRANSFER_COLLECTIONS, export_rows, import_rows
+
 # ================= Flask App =================
-app = Flask(__name__)
-app.secret_key = os.environ.get("SECRET_KEY", "supersecretkey")
+# Every route, the context processor and the CLI commands hang off this
+# blueprint; create_app() builds an app around it
+bp = Blueprint("main", __name__, cli_group=None)
 
-# ================= PATH FIX =================
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DATA_DIR = os.path.join(BASE_DIR, "data")
-os.makedirs(DATA_DIR, exist_ok=True)
-
-USERS_FILE = os.path.join(DATA_DIR, "users.json")
-PROJECTS_FILE = os.path.join(DATA_DIR, "projects.json")
-EXPENSES_FILE = os.path.join(DATA_DIR, "expenses.json")
-PROGRESS_FILE = os.path.join(DATA_DIR, "progress.json")
-MESSAGES_FILE = os.path.join(DATA_DIR, "messages.json")
-MISC_FILE = os.path.join(DATA_DIR, "misc_expenses.json")
-
-# Ensure JSON files exist
-for file in [
-    USERS_FILE,
-    PROJECTS_FILE,
-    EXPENSES_FILE,
-    PROGRESS_FILE,
-    MESSAGES_FILE,
-    MISC_FILE,
-]:
-    if not os.path.exists(file):
-        with open(file, "w") as f:
-            json.dump([], f)
+
+# Long-poll requests give up after this many seconds
+POLL_TIMEOUT = 25
+
+# Keyset pagination: newest first, ?before=<cursor>&limit=N for older pages
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+DATED_ORDER = ("date", "id")
+# What a cursor may hold for each sort field; every other field is text
+CURSOR_TYPES = {"id": int, "score": (int, float)}
+
+# ================= Configuration =================
+# Everything create_app() reads, taken from the environment unless the config
+# passed to create_app() says otherwise
+def default_config():
+    return {
+        "SECRET_KEY": os.environ.get("SECRET_KEY", "supersecretkey"),
+        "DATA_DIR": os.environ.get("DATA_DIR", os.path.join(BASE_DIR, "data")),
+        "DATABASE": os.environ.get("DATABASE", os.path.join(BASE_DIR, "database.db")),
+        # "json" keeps one file per collection in DATA_DIR, "sqlite" uses DATABASE
+        "STORAGE_BACKEND": os.environ.get("STORAGE_BACKEND", "json"),
+        # File format of the json backend: json, compact, jsonl or marshal.
+        # A file in another format is converted when it is first used.
+        "STORAGE_FORMAT": os.environ.get("STORAGE_FORMAT", "json"),
+        # Read messages older than this many months can move to the archive
+        # (flask archive-messages)
+        "ARCHIVE_MONTHS": int(os.environ.get("ARCHIVE_MONTHS", "6")),
+        "FRAGMENT_CACHE_ENTRIES": int(os.environ.get("FRAGMENT_CACHE_ENTRIES", "512")),
+        "FRAGMENT_CACHE_BYTES": int(os.environ.get("FRAGMENT_CACHE_BYTES", str(16 * 1024 * 1024))),
+        # Where the asyncio chat app (asgi.py) is served, e.g. "/chat"; pages
+        # then stream messages from it instead of long-polling
+        "CHAT_STREAM_URL": os.environ.get("CHAT_STREAM_URL", "").rstrip("/"),
+        # Server-Timing headers and /metrics (see profiling.py)
+        "PROFILE": os.environ.get("PROFILE") == "1",
+        "PROFILE_SAMPLE_RATE": float(os.environ.get("PROFILE_SAMPLE_RATE", "0")),
+        "PROFILE_DIR": os.environ.get("PROFILE_DIR", os.path.join(BASE_DIR, "profiles")),
+        # Lets a scraper read /metrics without an admin session
+        "METRICS_TOKEN": os.environ.get("METRICS_TOKEN", ""),
+        # Load the read-mostly data at startup (see preload())
+        "PRELOAD": os.environ.get("PRELOAD") == "1",
+    }
+
+# -------------------- Services --------------------
+# The storage and the indexes and caches around it belong to one app (see
+# create_app()); views reach those of the current app through these proxies
+def service(name):
+    return LocalProxy(lambda: getattr(current_app.extensions["softcentric"], name))
+
+
+storage = service("storage")
+unread_index = service("unread_index")
+expenses_by_project = service("expenses_by_project")
+progress_by_project = service("progress_by_project")
+misc_by_user = service("misc_by_user")
+misc_by_month = service("misc_by_month")
+projects_by_user = service("projects_by_user")
+accounts = service("accounts")
+conversations = service("conversations")
+message_archive = service("message_archive")
+inbox = service("inbox")
+misc_summary = service("misc_summary")
+text_indexes = service("text_indexes")
+expense_reports = service("expense_reports")
+fragment_cache = service("fragment_cache")
+notifier = service("notifier")
 
 # -------------------- Decorators --------------------
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
         if "username" not in session:
-            return redirect(url_for("login"))
+            return redirect(url_for("main.login"))
         return f(*args, **kwargs)
     return decorated_function
 
@@ -48,252 +117,306 @@ def admin_required(f):
     def decorated_function(*args, **kwargs):
         if session.get("role") != "admin":
             flash("Admin access required")
-            return redirect(url_for("dashboard"))
+            return redirect(url_for("main.dashboard"))
         return f(*args, **kwargs)
     return decorated_function
 
-# -------------------- JSON Helpers --------------------
-def read_json(file):
-    with open(file, "r") as f:
-        return json.load(f)
 
+def conditional(*collections):
+    # ETag from the versions of the collections a view reads plus everything
+    # else the page depends on; a matching If-None-Match gets a 304 without
+    # running the view at all.
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if session.get("_flashes"):
+                return f(*args, **kwargs)
+            etag = collections_etag(collections)
+            if request.if_none_match.contains(etag):
+                response = make_response("", 304)
+            else:
+                response = make_response(f(*args, **kwargs))
+            response.set_etag(etag)
+            response.headers["Cache-Control"] = "private, no-cache"
+            return response
+        return decorated_function
+    return decorator
 
-def write_json(file, data):
-    with open(file, "w") as f:
-        json.dump(data, f, indent=4)
 
+def collections_etag(collections):
+    username = session.get("username")
+    parts = [
+        request.full_path,
+        username,
+        session.get("role"),
+        datetime.now().strftime("%Y-%m"),
+        get_unread_count(username) if username else 0,
+    ]
+    parts.extend(storage.version(name) for name in collections)
+    return hashlib.sha1(repr(parts).encode("utf-8")).hexdigest()
 
+# -------------------- Helpers --------------------
 def get_unread_count(username):
-    messages = read_json(MESSAGES_FILE)
-    return sum(
-        1 for m in messages
-        if m["receiver"] == username and not m.get("read", False)
-    )
+    return unread_index.count(username)
+
+
+def user_projects(username):
+    return projects_by_user.get(username)
+
+
+def can_access(project_id):
+    return session.get("role") == "admin" or projects_by_user.member(session.get("username"), project_id)
+
+
+def new_message(sender, receiver, text):
+    return {
+        "sender": sender,
+        "receiver": receiver,
+        "message": text,
+        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "read": False
+    }
+
+
+def post_message(sender, receiver, text):
+    message = storage.insert("messages", new_message(sender, receiver, text))
+    notifier.bump(receiver)
+    return message
+
+# -------------------- Pagination --------------------
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(list(key)).encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor, order_by):
+    # A key must compare with sort_key(row, order_by), or paging would fail
+    if not cursor:
+        return None
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except ValueError:
+        abort(400)
+    if not isinstance(key, list) or len(key) != len(order_by):
+        abort(400)
+    for field, value in zip(order_by, key):
+        if isinstance(value, bool) or not isinstance(value, CURSOR_TYPES.get(field, str)):
+            abort(400)
+    return key
+
+
+def page_args(order_by):
+    limit = request.args.get("limit", PAGE_SIZE, type=int)
+    return max(1, min(limit, MAX_PAGE_SIZE)), decode_cursor(request.args.get("before"), order_by)
+
+
+def finish_page(rows, order_by, limit):
+    # rows holds up to limit + 1 entries; the extra one only says there is more
+    next_cursor = encode_cursor(sort_key(rows[limit - 1], order_by)) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+
+def paginate(name, order_by, rows=None, **where):
+    limit, before = page_args(order_by)
+    if rows is None:
+        rows = storage.page(name, order_by, limit + 1, before=before, **where)
+    else:
+        # Candidate rows from an index: filter and page them in memory
+        defaults = DEFAULTS.get(name)
+        rows = page_rows((r for r in rows if matches(r, where, defaults)), order_by, limit + 1, before)
+    return finish_page(rows, order_by, limit)
+
+
+def page_links(next_cursor):
+    args = request.args.to_dict()
+    args.pop("before", None)
+    args.pop("format", None)
+    older_url = url_for(request.endpoint, **request.view_args, **args, before=next_cursor) if next_cursor else None
+    newest_url = url_for(request.endpoint, **request.view_args, **args) if request.args.get("before") else None
+    return {"older_url": older_url, "newest_url": newest_url}
+
+
+def wants_json():
+    return request.args.get("format") == "json"
 
 # -------------------- Context Processor --------------------
-@app.context_processor
+@bp.app_context_processor
 def inject_unread_count():
     username = session.get("username")
     unread_count = get_unread_count(username) if username else 0
-    return dict(unread_count=unread_count)
+    return dict(unread_count=unread_count, chat_stream_url=current_app.config["CHAT_STREAM_URL"])
 
 # -------------------- Authentication --------------------
-@app.route("/", methods=["GET", "POST"])
+@bp.route("/", methods=["GET", "POST"])
 def login():
     if request.method == "POST":
         username = request.form["username"]
         password = request.form["password"]
-        users = read_json(USERS_FILE)
-        for user in users:
-            if user["username"] == username and user["password"] == password:
-                session["username"] = username
-                session["role"] = user["role"]
-                return redirect(url_for("dashboard"))
+        user = accounts.get(username)
+        if user and user["password"] == password:
+            session["username"] = username
+            session["role"] = user["role"]
+            return redirect(url_for("main.dashboard"))
         flash("Invalid username or password")
     return render_template("login.html")
 
 
-@app.route("/logout")
+@bp.route("/logout")
 def logout():
     session.clear()
-    return redirect(url_for("login"))
+    return redirect(url_for("main.login"))
 
 # -------------------- Dashboard --------------------
-@app.route("/dashboard")
+@bp.route("/dashboard")
 @login_required
 def dashboard():
     role = session.get("role")
     username = session.get("username")
 
-    all_projects = read_json(PROJECTS_FILE)
-    expenses = read_json(EXPENSES_FILE)
-    progress = read_json(PROGRESS_FILE)
-
     show_completed = request.args.get("completed", "").lower() == "true"
 
-    if role != "admin":
-        projects = [p for p in all_projects if username in p["users"]]
-        project_ids = [p["id"] for p in projects]
-        expenses = [e for e in expenses if e["project_id"] in project_ids]
-        progress = [p for p in progress if p["project_id"] in project_ids]
-    else:
-        projects = all_projects
+    def render():
+        projects = user_projects(username) if role != "admin" else storage.all("projects")
+        filtered_projects = [
+            p for p in projects
+            if (p.get("status", "").lower() == "completed") == show_completed
+        ]
+        return render_template("dashboard_projects.html", role=role, projects=filtered_projects, show_completed=show_completed)
 
-    filtered_projects = [
-        p for p in projects
-        if (p.get("status", "").lower() == "completed") == show_completed
-    ]
-
-    return render_template(
-        "dashboard.html",
-        role=role,
-        projects=filtered_projects,
-        expenses=expenses,
-        progress=progress,
-        unread_count=get_unread_count(username),
-        show_completed=show_completed,
-    )
+    # Every admin sees the same tables; other users see their own projects
+    scope = "admin" if role == "admin" else username
+    projects_table = fragment_cache.get(("dashboard", show_completed), scope, ("projects",), render)
+    return render_template("dashboard.html", projects_table=Markup(projects_table), show_completed=show_completed)
 
 # -------------------- Project Routes --------------------
-@app.route("/project/add", methods=["GET", "POST"])
+@bp.route("/project/add", methods=["GET", "POST"])
 @login_required
 @admin_required
 def project_add():
-    users = read_json(USERS_FILE)
+    users = storage.all("users")
     if request.method == "POST":
-        projects = read_json(PROJECTS_FILE)
-        projects.append({
-            "id": len(projects) + 1,
+        new_project = {
             "name": request.form["name"],
             "description": request.form["description"],
             "users": request.form.getlist("users"),
-            "status": "in-progress",
-        })
-        write_json(PROJECTS_FILE, projects)
-        return redirect(url_for("dashboard"))
+            "status": "in-progress"
+        }
+        storage.insert("projects", new_project)
+        return redirect(url_for("main.dashboard"))
     return render_template("project_add.html", users=users)
 
-@app.route("/project/<int:project_id>")
+@bp.route("/project/<int:project_id>")
 @login_required
 def project_detail(project_id):
-    projects = read_json(PROJECTS_FILE)
-    project = next((p for p in projects if p["id"] == project_id), None)
-    if not project:
-        flash("Project not found")
-        return redirect(url_for("dashboard"))
-    if session.get("role") != "admin" and session["username"] not in project["users"]:
-        flash("Access denied")
-        return redirect(url_for("dashboard"))
-
-    expenses = [e for e in read_json(EXPENSES_FILE) if e["project_id"] == project_id]
-    progress = [p for p in read_json(PROGRESS_FILE) if p["project_id"] == project_id]
-    for p in progress:
-        p.setdefault("instructions", "")
+    role = session.get("role")
+    username = session.get("username")
+    denied = []
 
-    return render_template(
-        "project_detail.html",
-        project=project,
-        expenses=expenses,
-        progress=progress,
-        role=session.get("role"),
-    )
+    def render():
+        project = storage.get("projects", id=project_id)
+        if not project:
+            denied.append("Project not found")
+            return None
+        if not can_access(project_id):
+            denied.append("Access denied")
+            return None
+        expenses = expenses_by_project.get(project_id)
+        progress = progress_by_project.get(project_id)
+        for p in progress:
+            if "instructions" not in p:
+                p["instructions"] = ""
+        return render_template("project_detail_body.html", project=project, expenses=expenses, progress=progress, role=role)
 
-# -------------------- Project Routes --------------------
-@app.route("/project/add", methods=["GET", "POST"])
-@login_required
-@admin_required
-def project_add():
-    users = read_json(USERS_FILE)
-    if request.method == "POST":
-        projects = read_json(PROJECTS_FILE)
-        new_project = {
-            "id": len(projects) + 1,
-            "name": request.form["name"],
-            "description": request.form["description"],
-            "users": request.form.getlist("users"),
-            "status": "in-progress"
-        }
-        projects.append(new_project)
-        write_json(PROJECTS_FILE, projects)
-        return redirect(url_for("dashboard"))
-    return render_template("project_add.html", users=users)
+    # A cached body also means the access check passed for this user at the
+    # same projects version
+    scope = "admin" if role == "admin" else username
+    project_body = fragment_cache.get(("project", project_id), scope, ("projects", "expenses", "progress"), render)
+    if project_body is None:
+        flash(denied[0])
+        return redirect(url_for("main.dashboard"))
+    return render_template("project_detail.html", project_body=Markup(project_body))
 
-@app.route("/project/edit/<int:project_id>", methods=["GET", "POST"])
+@bp.route("/project/edit/<int:project_id>", methods=["GET", "POST"])
 @login_required
 @admin_required
 def project_edit(project_id):
-    projects = read_json(PROJECTS_FILE)
-    project = next((p for p in projects if p["id"] == project_id), None)
+    project = storage.get("projects", id=project_id)
     if not project:
         flash("Project not found")
-        return redirect(url_for("dashboard"))
-    users = read_json(USERS_FILE)
+        return redirect(url_for("main.dashboard"))
+    users = storage.all("users")
     if request.method == "POST":
-        project["name"] = request.form["name"]
-        project["description"] = request.form["description"]
-        project["users"] = request.form.getlist("users")
-        write_json(PROJECTS_FILE, projects)
-        return redirect(url_for("dashboard"))
+        storage.update("projects", {
+            "name": request.form["name"],
+            "description": request.form["description"],
+            "users": request.form.getlist("users"),
+        }, id=project_id)
+        return redirect(url_for("main.dashboard"))
     return render_template("project_add.html", project=project, users=users)
 
-@app.route("/project/delete/<int:project_id>")
+@bp.route("/project/delete/<int:project_id>")
 @login_required
 @admin_required
 def project_delete(project_id):
-    projects = read_json(PROJECTS_FILE)
-    projects = [p for p in projects if p["id"] != project_id]
-    write_json(PROJECTS_FILE, projects)
-    return redirect(url_for("dashboard"))
+    storage.delete("projects", id=project_id)
+    return redirect(url_for("main.dashboard"))
 
-@app.route("/project/complete/<int:project_id>")
+@bp.route("/project/complete/<int:project_id>")
 @login_required
 @admin_required
 def project_complete(project_id):
-    projects = read_json(PROJECTS_FILE)
-    project = next((p for p in projects if p["id"] == project_id), None)
+    project = storage.get("projects", id=project_id)
     if project:
-        project["status"] = "completed"
-        write_json(PROJECTS_FILE, projects)
+        storage.update("projects", {"status": "completed"}, id=project_id)
         flash(f'Project "{project["name"]}" marked as completed.')
-    return redirect(url_for("dashboard"))
-
-@app.route("/project/<int:project_id>")
-@login_required
-def project_detail(project_id):
-    projects = read_json(PROJECTS_FILE)
-    project = next((p for p in projects if p["id"] == project_id), None)
-    if not project:
-        flash("Project not found")
-        return redirect(url_for("dashboard"))
-    if session.get("role") != "admin" and session.get("username") not in project["users"]:
-        flash("Access denied")
-        return redirect(url_for("dashboard"))
-    expenses = [e for e in read_json(EXPENSES_FILE) if e["project_id"] == project_id]
-    progress = [p for p in read_json(PROGRESS_FILE) if p["project_id"] == project_id]
-    for p in progress:
-        if "instructions" not in p:
-            p["instructions"] = ""
-    return render_template("project_detail.html", project=project, expenses=expenses, progress=progress, role=session.get("role"))
+    return redirect(url_for("main.dashboard"))
 
 # -------------------- Expense Routes --------------------
-@app.route("/expense/add", methods=["GET", "POST"])
+@bp.route("/expense/add", methods=["GET", "POST"])
 @login_required
 def add_expense():
-    projects = read_json(PROJECTS_FILE)
     if session.get("role") != "admin":
-        projects = [p for p in projects if session["username"] in p["users"]]
+        projects = user_projects(session["username"])
+    else:
+        projects = storage.all("projects")
     if request.method == "POST":
-        expenses = read_json(EXPENSES_FILE)
+        if not can_access(int(request.form["project_id"])):
+            flash("Access denied")
+            return redirect(url_for("main.dashboard"))
         new_expense = {
-            "id": len(expenses) + 1,
             "project_id": int(request.form["project_id"]),
             "amount": float(request.form["amount"]),
             "description": request.form["description"],
             "date": request.form["date"]
         }
-        expenses.append(new_expense)
-        write_json(EXPENSES_FILE, expenses)
-        return redirect(url_for("dashboard"))
+        storage.insert("expenses", new_expense)
+        return redirect(url_for("main.dashboard"))
     return render_template("add_expense.html", projects=projects)
 
-@app.route("/expense/view")
+@bp.route("/expense/view")
 @login_required
+@conditional("expenses", "projects")
 def view_expense():
     role = session.get("role")
-    expenses = read_json(EXPENSES_FILE)
-    all_projects = read_json(PROJECTS_FILE)
-    if role != "admin":
-        user_projects = [p["id"] for p in all_projects if session["username"] in p["users"]]
-        expenses = [e for e in expenses if e["project_id"] in user_projects]
+    all_projects = storage.all("projects")
     project_filter = request.args.get("project", "").strip()
     desc_filter = request.args.get("description", "").strip()
+    project_ids = None if role == "admin" else projects_by_user.project_ids(session["username"])
     if project_filter:
-        expenses = [e for e in expenses if str(e["project_id"]) == project_filter]
-    if desc_filter:
-        expenses = [e for e in expenses if e.get("description", "").lower() == desc_filter.lower()]
+        project_id = int(project_filter) if project_filter.isdigit() else project_filter
+        project_ids = [project_id] if project_ids is None or project_id in project_ids else []
+    if project_ids is None:
+        candidates = None
+        description_options = storage.distinct("expenses", "description")
+    else:
+        candidates = expenses_by_project.get(*project_ids)
+        description_options = {e.get("description") for e in candidates}
+    description_options = sorted(d for d in description_options if d)
+    where = {"description__iexact": desc_filter} if desc_filter else {}
+    expenses, next_cursor = paginate("expenses", DATED_ORDER, candidates, **where)
+    if wants_json():
+        return {"items": expenses, "next": next_cursor}
     projects = {p["id"]: p["name"] for p in all_projects}
     project_options = sorted(all_projects, key=lambda x: x["name"])
-    description_options = sorted({e.get("description", "") for e in expenses if e.get("description")})
     return render_template(
         "view_expense.html",
         expenses=expenses,
@@ -302,54 +425,59 @@ def view_expense():
         desc_filter=desc_filter,
         project_options=project_options,
         description_options=description_options,
-        role=role
+        role=role,
+        **page_links(next_cursor)
     )
 
 # -------------------- Progress Routes --------------------
-@app.route("/progress/add", methods=["GET", "POST"])
+@bp.route("/progress/add", methods=["GET", "POST"])
 @login_required
 def add_progress():
-    projects = read_json(PROJECTS_FILE)
     username = session.get("username")
     if session.get("role") != "admin":
-        projects = [p for p in projects if username in p["users"]]
+        projects = user_projects(username)
+    else:
+        projects = storage.all("projects")
     if request.method == "POST":
-        progress = read_json(PROGRESS_FILE)
+        if not can_access(int(request.form["project_id"])):
+            flash("Access denied")
+            return redirect(url_for("main.dashboard"))
         new_progress = {
-            "id": len(progress) + 1,
             "project_id": int(request.form["project_id"]),
             "update": request.form["update"],
             "date": request.form["date"],
             "user": username
         }
-        progress.append(new_progress)
-        write_json(PROGRESS_FILE, progress)
-        return redirect(url_for("dashboard"))
+        storage.insert("progress", new_progress)
+        return redirect(url_for("main.dashboard"))
     return render_template("add_progress.html", projects=projects)
 
-@app.route("/progress/view")
+@bp.route("/progress/view")
 @login_required
+@conditional("progress", "projects")
 def view_progress():
     role = session.get("role")
-    progress = read_json(PROGRESS_FILE)
-    all_projects = read_json(PROJECTS_FILE)
     if role != "admin":
-        user_project_ids = [p["id"] for p in all_projects if session["username"] in p["users"]]
-        all_projects = [p for p in all_projects if p["id"] in user_project_ids]
-        progress = [p for p in progress if p["project_id"] in user_project_ids]
+        all_projects = user_projects(session["username"])
+    else:
+        all_projects = storage.all("projects")
     project_filter = request.args.get("project", "")
     user_filter = request.args.get("user", "")
     show_completed = request.args.get("completed", "false").lower() == "true"
     projects_in_progress = {p["id"]: p for p in all_projects if p.get("status") != "completed"}
     projects_completed = {p["id"]: p for p in all_projects if p.get("status") == "completed"}
+    projects = projects_completed if show_completed else projects_in_progress
+    # Only progress the page can show: entries of the listed projects
+    project_ids = list(projects)
     if project_filter:
-        project_ids = [int(project_filter)]
-        progress = [p for p in progress if p["project_id"] in project_ids]
-    if user_filter:
-        progress = [p for p in progress if user_filter.lower() in p.get("user", "").lower()]
+        project_ids = [pid for pid in project_ids if str(pid) == project_filter]
+    candidates = progress_by_project.get(*project_ids)
+    user_options = sorted({p.get("user") for p in candidates if p.get("user")})
+    where = {"user__icontains": user_filter} if user_filter else {}
+    progress, next_cursor = paginate("progress", DATED_ORDER, candidates, **where)
+    if wants_json():
+        return {"items": progress, "next": next_cursor}
     project_options = sorted(all_projects, key=lambda x: x["name"])
-    user_options = sorted({p.get("user", "Unknown") for p in progress if p.get("user")})
-    projects = projects_completed if show_completed else projects_in_progress
     return render_template(
         "view_progress.html",
         progress=progress,
@@ -359,10 +487,11 @@ def view_progress():
         user_filter=user_filter,
         project_options=project_options,
         user_options=user_options,
-        show_completed=show_completed
+        show_completed=show_completed,
+        **page_links(next_cursor)
     )
 
-@app.route("/progress/<int:progress_id>/instruction", methods=["POST"])
+@bp.route("/progress/<int:progress_id>/instruction", methods=["POST"])
 @login_required
 @admin_required
 def add_instruction(progress_id):
@@ -370,147 +499,126 @@ def add_instruction(progress_id):
     if not instruction_text:
         flash("Instruction cannot be empty")
         return redirect(request.referrer)
-    progress = read_json(PROGRESS_FILE)
-    updated = False
-    for p in progress:
-        if p["id"] == progress_id:
-            p["instructions"] = instruction_text
-            updated = True
-            break
-    if updated:
-        write_json(PROGRESS_FILE, progress)
+    if storage.update("progress", {"instructions": instruction_text}, id=progress_id):
         flash("Instruction added successfully")
     else:
         flash("Progress entry not found")
     return redirect(request.referrer)
 
 # -------------------- User Management Routes --------------------
-@app.route("/users/manage", methods=["GET", "POST"])
+@bp.route("/users/manage", methods=["GET", "POST"])
 @login_required
 @admin_required
 def manage_users():
-    users = read_json(USERS_FILE)
     if request.method == "POST":
+        if accounts.get(request.form["username"]):
+            flash("User already exists")
+            return redirect(url_for("main.manage_users"))
         new_user = {
             "username": request.form["username"],
             "password": request.form["password"],
             "role": request.form["role"]
         }
-        users.append(new_user)
-        write_json(USERS_FILE, users)
-        return redirect(url_for("manage_users"))
+        storage.insert("users", new_user)
+        return redirect(url_for("main.manage_users"))
+    users = storage.all("users")
     return render_template("manage_users.html", users=users)
 
-@app.route("/user/<username>/edit", methods=["GET", "POST"])
+@bp.route("/user/<username>/edit", methods=["GET", "POST"])
 @login_required
 @admin_required
 def edit_user(username):
-    users = read_json(USERS_FILE)
-    user = next((u for u in users if u["username"] == username), None)
+    user = accounts.get(username)
     if not user:
         flash("User not found")
-        return redirect(url_for("manage_users"))
+        return redirect(url_for("main.manage_users"))
     if request.method == "POST":
         new_username = request.form.get("username")
         new_role = request.form.get("role")
-        if new_username and new_role:
-            user["username"] = new_username
-            user["role"] = new_role
-            write_json(USERS_FILE, users)
+        if new_username != username and accounts.get(new_username):
+            flash("User already exists")
+        elif new_username and new_role:
+            storage.update("users", {"username": new_username, "role": new_role}, username=username)
             flash("User updated successfully")
-            return redirect(url_for("manage_users"))
+            return redirect(url_for("main.manage_users"))
         else:
             flash("All fields are required")
     return render_template("edit_user.html", user=user)
 
-@app.route("/user/<username>/delete")
+@bp.route("/user/<username>/delete")
 @login_required
 @admin_required
 def delete_user(username):
-    users = read_json(USERS_FILE)
-    users = [u for u in users if u["username"] != username]
-    write_json(USERS_FILE, users)
+    storage.delete("users", username=username)
     flash("User deleted successfully")
-    return redirect(url_for("manage_users"))
+    return redirect(url_for("main.manage_users"))
 
-@app.route("/users/change_password", methods=["GET", "POST"])
+@bp.route("/users/change_password", methods=["GET", "POST"])
 @login_required
 def change_password():
-    users = read_json(USERS_FILE)
     if request.method == "POST":
         old_password = request.form.get("old_password")
         new_password = request.form.get("new_password")
         confirm_password = request.form.get("confirm_password")
-        for user in users:
-            if user["username"] == session["username"]:
-                if user["password"] != old_password:
-                    flash("Old password is incorrect")
-                    return redirect(url_for("change_password"))
-                if new_password != confirm_password:
-                    flash("New passwords do not match")
-                    return redirect(url_for("change_password"))
-                user["password"] = new_password
-                write_json(USERS_FILE, users)
-                flash("Password changed successfully")
-                return redirect(url_for("dashboard"))
+        user = accounts.get(session["username"])
+        if user:
+            if user["password"] != old_password:
+                flash("Old password is incorrect")
+                return redirect(url_for("main.change_password"))
+            if new_password != confirm_password:
+                flash("New passwords do not match")
+                return redirect(url_for("main.change_password"))
+            storage.update("users", {"password": new_password}, username=user["username"])
+            flash("Password changed successfully")
+            return redirect(url_for("main.dashboard"))
     return render_template("change_password.html")
 
 # -------------------- Messaging Routes --------------------
-@app.route("/messages")
+@bp.route("/messages")
 @login_required
 def messages():
     current_user = session["username"]
-    all_users = read_json(USERS_FILE)
-    messages_data = read_json(MESSAGES_FILE)
-    conversations = {}
-    unread_counts = {}
-    for msg in messages_data:
-        if current_user in [msg["sender"], msg["receiver"]]:
-            other_user = msg["receiver"] if msg["sender"] == current_user else msg["sender"]
-            if other_user not in conversations:
-                conversations[other_user] = []
-                unread_counts[other_user] = 0
-            conversations[other_user].append(msg)
-            if msg["receiver"] == current_user and not msg.get("read", False):
-                unread_counts[other_user] += 1
-    for conv in conversations.values():
-        conv.sort(key=lambda x: x.get("timestamp", ""))
-    return render_template("messages.html", conversations=conversations, current_user=current_user, all_users=all_users, unread_counts=unread_counts)
-
-@app.route("/messages/<receiver>", methods=["GET", "POST"])
+    all_users = storage.all("users")
+    # Conversations whose messages are all archived keep their last preview
+    threads = {other: message_preview(m) for other, m in message_archive.threads(current_user).items()}
+    threads.update(inbox.threads(current_user))
+    unread_counts = unread_index.by_sender(current_user)
+    conversations = sorted(
+        ({"user": other, "unread": unread_counts.get(other, 0), **last} for other, last in threads.items()),
+        key=lambda c: sort_key(c, MESSAGE_ORDER), reverse=True,
+    )
+    return render_template("messages.html", conversations=conversations, current_user=current_user, all_users=all_users)
+
+@bp.route("/messages/<receiver>", methods=["GET", "POST"])
 @login_required
 def chat_with(receiver):
     username = session["username"]
-    messages_data = read_json(MESSAGES_FILE)
-    conversation = [m for m in messages_data if (m["sender"] == username and m["receiver"] == receiver) or (m["sender"] == receiver and m["receiver"] == username)]
+    limit, before = page_args(MESSAGE_ORDER)
+    # Newest page of the live conversation; older pages via ?before= reach
+    # into the archive once they go back past what is still live
+    conversation = conversations.page(pair_key(username, receiver), MESSAGE_ORDER, limit + 1, before)
+    if message_archive.needed(conversation, limit):
+        conversation += message_archive.page(username, receiver, limit + 1, before)
+        conversation = page_rows(conversation, MESSAGE_ORDER, limit + 1)
+    conversation, next_cursor = finish_page(conversation, MESSAGE_ORDER, limit)
+    conversation.reverse()
     for m in conversation:
         if "timestamp" not in m:
             m["timestamp"] = "1970-01-01T00:00:00"
-    conversation.sort(key=lambda x: x["timestamp"])
-    updated = False
-    for m in messages_data:
-        if m["receiver"] == username and m["sender"] == receiver and not m.get("read", False):
-            m["read"] = True
-            updated = True
-    if updated:
-        write_json(MESSAGES_FILE, messages_data)
+    if request.method == "GET" and wants_json():
+        return {"items": conversation, "next": next_cursor}
+    # Only write when there is something to mark; most views find nothing unread
+    if unread_index.by_sender(username).get(receiver):
+        if storage.update("messages", {"read": True}, receiver=username, sender=receiver, read=False):
+            notifier.bump(username)
     if request.method == "POST":
         content = request.form.get("message")
         if content:
-            new_message = {
-                "id": len(messages_data) + 1,
-                "sender": username,
-                "receiver": receiver,
-                "message": content,
-                "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                "read": False
-            }
-            messages_data.append(new_message)
-            write_json(MESSAGES_FILE, messages_data)
-            return redirect(url_for("chat_with", receiver=receiver))
-    return render_template("chat.html", conversation=conversation, receiver=receiver, username=username)
-
-@app.route("/messages/send", methods=["POST"])
+            post_message(username, receiver, content)
+            return redirect(url_for("main.chat_with", receiver=receiver))
+    return render_template("chat.html", conversation=conversation, receiver=receiver, username=username, **page_links(next_cursor))
+
+@bp.route("/messages/send", methods=["POST"])
 @login_required
 def send_message():
     sender = session["username"]
@@ -518,38 +626,46 @@ def send_message():
     message_text = request.form.get("message")
     if not receiver or not message_text:
         flash("Both receiver and message are required")
-        return redirect(url_for("messages"))
-    messages_data = read_json(MESSAGES_FILE)
-    new_message = {
-        "id": len(messages_data) + 1,
-        "sender": sender,
-        "receiver": receiver,
-        "message": message_text,
-        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        "read": False
-    }
-    messages_data.append(new_message)
-    write_json(MESSAGES_FILE, messages_data)
-    return redirect(url_for("messages"))
+        return redirect(url_for("main.messages"))
+    post_message(sender, receiver, message_text)
+    return redirect(url_for("main.messages"))
 
-@app.route("/messages/unread_details")
+@bp.route("/messages/unread_details")
 @login_required
+@conditional("messages")
 def unread_details():
     username = session["username"]
-    messages_data = read_json(MESSAGES_FILE)
-    unread = [m for m in messages_data if m["receiver"] == username and not m.get("read", False)]
+    unread = unread_index.messages(username)
     return {"unread": unread}
 
+@bp.route("/messages/poll")
+@login_required
+def poll_messages():
+    # Long-poll: answers as soon as the user's notification sequence moves
+    # past ?since=, or with the unchanged sequence after the timeout
+    username = session["username"]
+    since = request.args.get("since", type=int)
+    timeout = request.args.get("timeout", POLL_TIMEOUT, type=float)
+    # nan would compare false against every deadline and never return
+    if not math.isfinite(timeout):
+        abort(400)
+    timeout = max(0.0, min(timeout, POLL_TIMEOUT))
+    if since is None:
+        seq = notifier.sequence(username)
+    else:
+        seq = notifier.wait(username, since, timeout)
+        if seq == since:
+            return {"seq": seq, "changed": False}
+    return {"seq": seq, "changed": True, "unread": unread_index.messages(username)}
+
 # -------------------- Miscellaneous Expense Routes --------------------
-@app.route("/misc/add", methods=["GET", "POST"])
+@bp.route("/misc/add", methods=["GET", "POST"])
 @login_required
 def add_misc_expense():
     role = session.get("role")
-    users = read_json(USERS_FILE)
+    users = storage.all("users")
     if request.method == "POST":
-        misc_expenses = read_json(MISC_FILE)
         new_expense = {
-            "id": len(misc_expenses) + 1,
             "date": request.form["date"],
             "user": request.form["user"],
             "description": request.form["description"],
@@ -557,43 +673,55 @@ def add_misc_expense():
             "paid_by": request.form["paid_by"],
             "remarks": request.form.get("remarks", "")
         }
-        misc_expenses.append(new_expense)
-        write_json(MISC_FILE, misc_expenses)
+        storage.insert("misc_expenses", new_expense)
         flash("Miscellaneous expense added successfully")
-        return redirect(url_for("view_misc_expense"))
+        return redirect(url_for("main.view_misc_expense"))
     return render_template("add_misc_expense.html", users=users, role=role)
 
-@app.route("/misc/view")
+@bp.route("/misc/view")
 @login_required
+@conditional("misc_expenses")
 def view_misc_expense():
     role = session.get("role")
-    misc_expenses = read_json(MISC_FILE)
     user_filter = request.args.get("user", "").strip()
     desc_filter = request.args.get("description", "").strip()
     paid_by_filter = request.args.get("paid_by", "").strip()
     month_filter = request.args.get("month", "").strip()
     show_previous = request.args.get("previous", "false").lower() == "true"
-    if role != "admin":
-        misc_expenses = [e for e in misc_expenses if e["user"] == session["username"]]
+    user = session["username"] if role != "admin" else user_filter
     current_month = datetime.now().strftime("%Y-%m")
     if show_previous:
-        misc_expenses = [e for e in misc_expenses if e["date"][:7] < current_month]
+        months = [month_filter] if month_filter else misc_by_month.keys()
+        months = [m for m in months if m < current_month]
     else:
-        misc_expenses = [e for e in misc_expenses if e["date"][:7] == current_month]
-    if user_filter and role == "admin":
-        misc_expenses = [e for e in misc_expenses if e["user"] == user_filter]
+        # Current month only, so any other month filter matches nothing
+        months = [current_month] if month_filter in ("", current_month) else []
+    where = {}
     if desc_filter:
-        misc_expenses = [e for e in misc_expenses if e["description"] == desc_filter]
+        where["description"] = desc_filter
     if paid_by_filter:
-        misc_expenses = [e for e in misc_expenses if e.get("paid_by", "") == paid_by_filter]
-    if month_filter:
-        misc_expenses = [e for e in misc_expenses if e["date"][:7] == month_filter]
-    all_expenses = read_json(MISC_FILE)
-    users = sorted({e["user"] for e in all_expenses})
-    descriptions = sorted({e["description"] for e in all_expenses})
-    paid_by_list = sorted({e.get("paid_by", "") for e in all_expenses if e.get("paid_by")})
-    months = sorted({e["date"][:7] for e in all_expenses}, reverse=True)
-    total_amount = sum(float(e["amount"]) for e in misc_expenses)
+        where["paid_by"] = paid_by_filter
+    # Start from whichever index gives fewer rows
+    if user and misc_by_user.size(user) < misc_by_month.size(*months):
+        wanted = set(months)
+        candidates = [e for e in misc_by_user.get(user) if e.get("date", "")[:7] in wanted]
+    else:
+        candidates = misc_by_month.get(*months)
+        if user:
+            where["user"] = user
+    defaults = DEFAULTS.get("misc_expenses")
+    candidates = [e for e in candidates if matches(e, where, defaults)]
+    misc_expenses, next_cursor = paginate("misc_expenses", DATED_ORDER, candidates)
+    if desc_filter:
+        total_amount = sum((float(e.get("amount") or 0) for e in candidates), 0.0)
+    else:
+        total_amount = misc_summary.total(months, user or None, paid_by_filter or None)
+    if wants_json():
+        return {"items": misc_expenses, "next": next_cursor, "total_amount": total_amount}
+    users = sorted(misc_summary.options("user"))
+    descriptions = sorted(misc_summary.options("description"))
+    paid_by_list = sorted(misc_summary.options("paid_by"))
+    months = sorted(misc_summary.options("month"), reverse=True)
     return render_template(
         "view_misc_expense.html",
         misc_expenses=misc_expenses,
@@ -607,9 +735,364 @@ def view_misc_expense():
         paid_by_list=paid_by_list,
         months=months,
         total_amount=total_amount,
-        show_previous=show_previous
+        show_previous=show_previous,
+        **page_links(next_cursor)
+    )
+
+# -------------------- Search Routes --------------------
+def search_filter(source):
+    # Which rows of source the current user may find
+    username = session["username"]
+    if source == "messages":
+        return lambda m: username in (m.get("sender"), m.get("receiver"))
+    if session.get("role") == "admin":
+        return None
+    if source == "misc_expenses":
+        return lambda e: e.get("user") == username
+    project_ids = projects_by_user.project_ids(username)
+    return lambda r: r.get("project_id") in project_ids
+
+
+@bp.route("/search")
+@login_required
+def search():
+    query = request.args.get("q", "").strip()
+    source = request.args.get("in", "messages")
+    if source not in SEARCH_FIELDS and source != ARCHIVE_SOURCE:
+        abort(400)
+    limit, before = page_args(SEARCH_ORDER)
+    if source == ARCHIVE_SOURCE:
+        # Archived messages have no index; rank the user's own segments
+        history = message_archive.history(session["username"])
+        results = search_rows(history, SEARCH_FIELDS["messages"], query, limit + 1, before)
+    else:
+        results = text_indexes[source].search(query, limit + 1, before, search_filter(source))
+    results, next_cursor = finish_page(results, SEARCH_ORDER, limit)
+    if wants_json():
+        return {"items": results, "next": next_cursor}
+    projects = {p["id"]: p["name"] for p in storage.all("projects")}
+    return render_template(
+        "search.html",
+        query=query,
+        source=source,
+        sources=SEARCH_FIELDS,
+        results=results,
+        projects=projects,
+        current_user=session["username"],
+        **page_links(next_cursor)
+    )
+
+# -------------------- Report Routes --------------------
+@bp.route("/reports")
+@login_required
+@admin_required
+@conditional("expenses", "misc_expenses", "projects")
+def reports():
+    source = request.args.get("source", "expenses")
+    if source not in DIMENSIONS:
+        abort(400)
+    by = request.args.getlist("by") or ["month"]
+    if len(set(by)) != len(by) or any(d not in DIMENSIONS[source] for d in by):
+        abort(400)
+    groups = expense_reports.report(source, by)
+    if wants_json():
+        return {"source": source, "by": by, "groups": groups}
+    project_names = {p["id"]: p["name"] for p in storage.all("projects")}
+    return render_template(
+        "reports.html",
+        source=source,
+        by=by,
+        groups=groups,
+        dimensions=DIMENSIONS,
+        project_names=project_names,
+    )
+
+# -------------------- JSON API Routes --------------------
+def api_response(data, status=200):
+    return Response(dumps(data), status=status, mimetype="application/json")
+
+
+def api_login_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if "username" not in session:
+            return api_response({"error": "login required"}, 401)
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+def api_batch():
+    by_project = {"expenses": expenses_by_project, "progress": progress_by_project}
+    if session.get("role") == "admin":
+        return Batch(storage, by_project, storage.all("projects"), everything=True)
+    return Batch(storage, by_project, user_projects(session["username"]))
+
+
+@bp.route(f"/api/v{API_VERSION}/<resource>")
+@api_login_required
+def api_resource(resource):
+    try:
+        result = api_batch().run(dict(request.args.items(), resource=resource))
+    except ValueError as e:
+        return api_response({"error": str(e)}, 400)
+    return api_response(result)
+
+
+@bp.route(f"/api/v{API_VERSION}/batch", methods=["POST"])
+@api_login_required
+def api_batch_fetch():
+    body = request.get_json(silent=True)
+    requests = body.get("requests") if isinstance(body, dict) else None
+    if not isinstance(requests, list) or not 0 < len(requests) <= MAX_BATCH:
+        return api_response({"error": f"requests must be a list of 1 to {MAX_BATCH} requests"}, 400)
+    batch = api_batch()
+    responses = []
+    for item in requests:
+        try:
+            responses.append(batch.run(item))
+        except ValueError as e:
+            responses.append({"error": str(e)})
+    return api_response({"responses": responses})
+
+# -------------------- Export / Import Routes --------------------
+@bp.route("/export/<name>.<fmt>")
+@login_required
+@admin_required
+def export_collection(name, fmt):
+    if name not in TRANSFER_COLLECTIONS or fmt not in FORMATS:
+        abort(404)
+    # The rows are streamed after the app context is gone; hand over the
+    # storage itself, not the proxy
+    return Response(
+        export_rows(storage._get_current_object(), name, fmt),
+        mimetype=FORMATS[fmt],
+        headers={"Content-Disposition": f"attachment; filename={name}.{fmt}"},
     )
 
+
+@contextmanager
+def uploaded_text(upload):
+    # Text view of the upload that leaves it open, so it can be read again
+    upload.stream.seek(0)
+    text = io.TextIOWrapper(upload.stream, encoding="utf-8", newline="")
+    try:
+        yield text
+    finally:
+        text.detach()
+
+
+@bp.route("/import/<name>", methods=["POST"])
+@login_required
+@admin_required
+def import_collection(name):
+    upload = request.files.get("file")
+    if name not in TRANSFER_COLLECTIONS or upload is None:
+        abort(400)
+    fmt = request.form.get("format") or upload.filename.rsplit(".", 1)[-1].lower()
+    if fmt not in FORMATS:
+        abort(400)
+    imported, errors = import_rows(storage, name, lambda: uploaded_text(upload), fmt)
+    if errors:
+        return {"imported": 0, "errors": errors}, 400
+    return {"imported": imported}
+
+# -------------------- Admin Routes --------------------
+@bp.route("/admin/cache")
+@login_required
+@admin_required
+def cache_stats():
+    indexes = {
+        "unread": unread_index,
+        "expenses_by_project": expenses_by_project,
+        "progress_by_project": progress_by_project,
+        "misc_by_user": misc_by_user,
+        "misc_by_month": misc_by_month,
+        "projects_by_user": projects_by_user,
+        "accounts": accounts,
+        "conversations": conversations,
+        "inbox": inbox,
+        "misc_summary": misc_summary,
+        **{f"search_{name}": index for name, index in text_indexes.items()},
+    }
+    stats = {"read_cache": read_cache.stats(), "index_rebuilds": {k: i.rebuilds for k, i in indexes.items()}}
+    stats["report_builds"] = expense_reports.builds
+    stats["fragment_cache"] = fragment_cache.stats()
+    if isinstance(storage, JsonStorage):
+        stats["writes"] = storage.write_stats()
+    return stats
+
+# -------------------- App Factory --------------------
+# Everything an app keeps between requests, set up from its config. Nothing
+# here touches the disk: each collection is created, converted or recovered
+# the first time a request uses it.
+class Services:
+    def __init__(self, config):
+        data_dir = config["DATA_DIR"]
+        self.storage = storage = open_storage(config["STORAGE_BACKEND"], data_dir, config["DATABASE"], config["STORAGE_FORMAT"])
+
+        # Unread counters kept current by every message write
+        self.unread_index = UnreadIndex(storage)
+
+        # Secondary indexes for the filter views, built on first use
+        self.expenses_by_project = ExpensesByProject(storage)
+        self.progress_by_project = ProgressByProject(storage)
+        self.misc_by_user = MiscByUser(storage)
+        self.misc_by_month = MiscByMonth(storage)
+        self.projects_by_user = ProjectsByUser(storage)
+
+        # Users by username and each user's project ids, for login and the
+        # access checks of every non-admin view
+        self.accounts = Accounts(storage)
+
+        # Live messages per conversation; old read ones move to monthly
+        # per-conversation archive segments
+        self.conversations = Conversations(storage)
+        self.message_archive = MessageArchive(os.path.join(data_dir, "archive", "messages"))
+
+        # Last message of every conversation of each user, for the inbox
+        self.inbox = Inbox(storage, self.conversations)
+
+        # Dropdown options and totals of the misc expense page
+        self.misc_summary = MiscSummary(storage)
+
+        # Full-text search over the free-text fields of each collection
+        self.text_indexes = {name: TextIndex(storage, name) for name in SEARCH_FIELDS}
+
+        # Grouped spend reports, recomputed when their collection changes
+        self.expense_reports = Reports(storage)
+
+        # Rendered project tables of the dashboard and project pages
+        self.fragment_cache = FragmentCache(
+            storage,
+            max_entries=config["FRAGMENT_CACHE_ENTRIES"],
+            max_bytes=config["FRAGMENT_CACHE_BYTES"],
+        )
+
+        # Per-user change counters that wake long-polling clients in any worker
+        self.notifier = Notifier(os.path.join(data_dir, "notify"))
+
+
+def create_app(config=None):
+    app = Flask(__name__)
+    app.config.update(default_config())
+    app.config.update(config or {})
+    app.secret_key = app.config["SECRET_KEY"]
+    services = app.extensions["softcentric"] = Services(app.config)
+    app.register_blueprint(bp)
+    if app.config["PROFILE"]:
+        from profiling import Profiler
+        Profiler(
+            app, services.storage, sample_rate=app.config["PROFILE_SAMPLE_RATE"],
+            profile_dir=app.config["PROFILE_DIR"], token=app.config["METRICS_TOKEN"],
+        )
+    if app.config["PRELOAD"]:
+        preload(app)
+    return app
+
+
+def preload(app):
+    # With gunicorn --preload this runs once in the master before it forks:
+    # users and projects are parsed, the indexes every page needs are built
+    # and the templates compiled, and the workers share all of it
+    # copy-on-write instead of each loading it again. gc.freeze() keeps the
+    # collector from touching, and so copying, those pages in the workers.
+    services = app.extensions["softcentric"]
+    services.storage.prepare()
+    for name in ("users", "projects"):
+        services.storage.all(name)
+    for index in (services.unread_index, services.projects_by_user, services.accounts):
+        index.ensure()
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+    gc.collect()
+    gc.freeze()
+
+# -------------------- CLI Commands --------------------
+@bp.cli.command("import-json")
+def import_json():
+    """Copy every collection from DATA_DIR into the configured storage."""
+    config = current_app.config
+    if config["STORAGE_BACKEND"] == "json":
+        print("STORAGE_BACKEND is json, nothing to import")
+        return
+    source = JsonStorage(config["DATA_DIR"], config["STORAGE_FORMAT"])
+    for name in COLLECTIONS:
+        rows = source.all(name)
+        ids = [r["id"] for r in rows if r.get("id") is not None] if primary_key(name) == "id" else []
+        if len(ids) != len(set(ids)):
+            print(f"{name}: duplicate IDs in {config['DATA_DIR']}, run 'flask fix-ids' with STORAGE_BACKEND=json first")
+            continue
+        storage.replace(name, rows)
+        print(f"{name}: imported {len(rows)} records")
+
+
+@bp.cli.command("convert-storage")
+@click.argument("fmt", type=click.Choice(sorted(FILE_FORMATS)))
+def convert_storage(fmt):
+    """Rewrite every collection file in DATA_DIR in FMT; json is the readable one."""
+    config = current_app.config
+    converted = JsonStorage(config["DATA_DIR"], fmt).prepare()
+    for name, old, new in converted:
+        print(f"{name}: {old} -> {new}")
+    if not converted:
+        print(f"every collection is already stored as {fmt}")
+    if fmt != config["STORAGE_FORMAT"]:
+        print(f"set STORAGE_FORMAT={fmt} before starting the app, or it converts the files back")
+
+
+@bp.cli.command("import-rows")
+@click.argument("name", type=click.Choice(TRANSFER_COLLECTIONS))
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+def import_rows_command(name, path):
+    """Validate a CSV or JSON Lines file and append its rows to NAME."""
+    fmt = path.rsplit(".", 1)[-1].lower()
+    if fmt not in FORMATS:
+        raise click.UsageError("PATH must end in .csv or .jsonl")
+    imported, errors = import_rows(storage, name, lambda: open(path, "r", encoding="utf-8", newline=""), fmt)
+    for error in errors:
+        print(error)
+    if errors:
+        raise SystemExit(1)
+    print(f"{name}: imported {imported} records")
+
+
+@bp.cli.command("archive-messages")
+@click.option("--months", type=int, default=None, show_default="ARCHIVE_MONTHS", help="Keep this many months of read messages live.")
+def archive_messages(months):
+    """Move old read messages into per-conversation monthly archive segments."""
+    if months is None:
+        months = current_app.config["ARCHIVE_MONTHS"]
+    print(f"messages: archived {message_archive.archive(storage, months)} read messages")
+
+
+@bp.cli.command("fix-ids")
+def fix_ids():
+    """Give fresh IDs to records that share an ID with an earlier record."""
+    for name in COLLECTIONS:
+        if primary_key(name) != "id":
+            continue
+        renumbered = storage.fix_duplicate_ids(name)
+        for old, new in renumbered:
+            print(f"{name}: record {old} renumbered to {new}" if old is not None else f"{name}: record without ID numbered {new}")
+        if name == "projects" and renumbered:
+            print("projects: expenses and progress still point at the old IDs, check them by hand")
+        if not renumbered:
+            print(f"{name}: no duplicate IDs")
+
+
+@bp.cli.command("compact-logs")
+def compact_logs():
+    """Fold the append-only logs of the JSON backend into their snapshots."""
+    if not isinstance(storage, JsonStorage):
+        print(f"STORAGE_BACKEND is {current_app.config['STORAGE_BACKEND']}, nothing to compact")
+        return
+    for name in sorted(LOG_COLLECTIONS):
+        print(f"{name}: folded {storage.compact(name)} log events")
+
 # -------------------- Run App --------------------
+# The app of "gunicorn app:app" and "flask --app app", configured from the
+# environment
+app = create_app()
+
 if __name__ == "__main__":
     app.run(debug=True)
@@ -0,0 +1,153 @@
+import hashlib
+import json
+import os
+from datetime import datetime
+
+from storage import file_lock, page_rows, replace_file, sort_key
+
+# -------------------- Message Archive --------------------
+# Read messages older than the archive window leave the live collection for
+# cold segment files, one per conversation and month:
+#   <directory>/<YYYY-MM>/<sha1 of the pair>.jsonl
+# so a chat that pages back into its history reads only its own segments,
+# newest month first. cutoff.json records the newest timestamp archived so
+# far: everything archived sorts below it, which tells a reader when the live
+# collection alone is enough. latest.json keeps the newest archived message of
+# every conversation, so a conversation whose messages are all archived still
+# shows up in the inbox.
+MESSAGE_ORDER = ("timestamp", "id")
+
+
+def pair_key(a, b):
+    return tuple(sorted((a, b)))
+
+
+def months_before(now, months):
+    # First day of the month `months` months before now, as a timestamp prefix
+    index = now.year * 12 + now.month - 1 - months
+    return f"{index // 12:04d}-{index % 12 + 1:02d}"
+
+
+class MessageArchive:
+    def __init__(self, directory):
+        self.directory = directory
+
+    def segment_path(self, month, pair):
+        digest = hashlib.sha1("\0".join(pair).encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, month, f"{digest}.jsonl")
+
+    def cutoff(self):
+        try:
+            with open(os.path.join(self.directory, "cutoff.json"), "r") as f:
+                return json.load(f)["cutoff"]
+        except FileNotFoundError:
+            return ""
+
+    def _set_cutoff(self, cutoff):
+        path = os.path.join(self.directory, "cutoff.json")
+        with file_lock(path):
+            if cutoff > self.cutoff():
+                replace_file(path, lambda f: json.dump({"cutoff": cutoff}, f))
+
+    def latest(self):
+        try:
+            with open(os.path.join(self.directory, "latest.json"), "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _set_latest(self, newest):
+        path = os.path.join(self.directory, "latest.json")
+        with file_lock(path):
+            latest = self.latest()
+            for pair, message in newest.items():
+                key = "\0".join(pair)
+                if key not in latest or sort_key(message, MESSAGE_ORDER) > sort_key(latest[key], MESSAGE_ORDER):
+                    latest[key] = message
+            replace_file(path, lambda f: json.dump(latest, f))
+
+    def threads(self, user):
+        # counterpart -> newest archived message, for each conversation of user
+        threads = {}
+        for key, message in self.latest().items():
+            a, b = key.split("\0")
+            if user in (a, b):
+                threads[b if a == user else a] = message
+        return threads
+
+    def history(self, user):
+        # Every archived message of user, reading only the segments of the
+        # user's own conversations
+        pairs = [pair_key(user, other) for other in self.threads(user)]
+        for month in self.months():
+            for pair in pairs:
+                yield from self._read(self.segment_path(month, pair))
+
+    def months(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted((d for d in os.listdir(self.directory) if len(d) == 7 and d[4] == "-"), reverse=True)
+
+    def _read(self, path):
+        try:
+            with open(path, "r") as f:
+                return [json.loads(line) for line in f if line.endswith("\n")]
+        except FileNotFoundError:
+            return []
+
+    def _append(self, path, messages):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with file_lock(path):
+            # A rerun after a crash between append and delete must not
+            # archive the same message twice
+            stored = {m.get("id") for m in self._read(path)}
+            fresh = [m for m in messages if m["id"] not in stored]
+            if not fresh:
+                return
+            with open(path, "a") as f:
+                f.write("".join(json.dumps(m, separators=(",", ":")) + "\n" for m in fresh))
+                f.flush()
+                os.fsync(f.fileno())
+
+    def archive(self, storage, months, now=None):
+        # Moves read messages from before the window into their segments,
+        # then drops them from the live collection. Returns how many moved.
+        cutoff = months_before(now or datetime.now(), months)
+        os.makedirs(self.directory, exist_ok=True)
+        old = [m for m in storage.find("messages", read=True, timestamp__lt=cutoff) if m.get("id") is not None]
+        segments = {}
+        for m in old:
+            segments.setdefault((m["timestamp"][:7], pair_key(m["sender"], m["receiver"])), []).append(m)
+        for (month, pair), messages in segments.items():
+            messages.sort(key=lambda m: sort_key(m, MESSAGE_ORDER))
+            self._append(self.segment_path(month, pair), messages)
+        if old:
+            self._set_latest({pair: messages[-1] for (_, pair), messages in sorted(segments.items())})
+            self._set_cutoff(max(m["timestamp"] for m in old))
+            ids = [m["id"] for m in old]
+            for i in range(0, len(ids), 500):
+                storage.delete("messages", id__in=ids[i:i + 500])
+        return len(old)
+
+    def needed(self, rows, limit):
+        # rows: a live page of limit + 1 rows, newest first. The archive can
+        # only hold rows for this page if the page is short or reaches back
+        # past the newest archived timestamp.
+        cutoff = self.cutoff()
+        if not cutoff:
+            return False
+        return len(rows) <= limit or (rows[limit - 1].get("timestamp") or "") <= cutoff
+
+    def page(self, a, b, limit, before=None):
+        # Newest first, like Storage.page, reading one month at a time
+        pair = pair_key(a, b)
+        first = before[0][:7] if before is not None and before[0] else None
+        found = []
+        for month in self.months():
+            if first is not None and month > first:
+                continue
+            found += page_rows(self._read(self.segment_path(month, pair)), MESSAGE_ORDER, limit, before)
+            if len(found) >= limit:
+                # Older months only hold older messages
+                break
+        return page_rows(found, MESSAGE_ORDER, limit)
@@ -0,0 +1,11 @@
+from app import app, new_message
+from realtime import ChatApp
+
+# -------------------- ASGI Entry Point --------------------
+# uvicorn asgi:application --workers 1
+# Route CHAT_STREAM_URL (default /chat) here and the rest to gunicorn.
+services = app.extensions["softcentric"]
+application = ChatApp(
+    app, services.storage, services.notifier, services.unread_index, new_message,
+    prefix=app.config["CHAT_STREAM_URL"] or "/chat",
+)
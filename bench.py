@@ -0,0 +1,350 @@
+import argparse
+import http.cookiejar
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+try:
+    import resource
+except ImportError:  # Windows: no peak RSS for the test client run
+    resource = None
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# -------------------- Synthetic Data --------------------
+# Every collection gets about `rows` records; users and projects grow with it
+# so per-user and per-project lists keep a realistic size.
+SCALES = {"1k": 1_000, "100k": 100_000, "1m": 1_000_000}
+PASSWORD = "bench"
+
+
+def parse_scale(value):
+    return SCALES.get(value.lower()) or int(value)
+
+
+def synthetic_data(rows, seed=1):
+    # Yields (collection, records) one collection at a time so only one of
+    # them is in memory at the largest scales
+    rnd = random.Random(seed)
+    n_users = min(max(rows // 1000, 10), 200)
+    n_projects = min(max(rows // 200, 5), 5000)
+    users = [{"username": "admin", "password": PASSWORD, "role": "admin"}]
+    users += [{"username": f"user{i}", "password": PASSWORD, "role": "user"} for i in range(n_users)]
+    names = [u["username"] for u in users[1:]]
+    yield "users", users
+    projects = []
+    for i in range(1, n_projects + 1):
+        # user0 and user1 share a few projects so their pages are never empty
+        members = rnd.sample(names, 3) if i > 3 else ["user0", "user1", rnd.choice(names)]
+        projects.append({
+            "id": i,
+            "name": f"Project {i}",
+            "description": "Synthetic project",
+            "users": sorted(set(members)),
+            "status": "completed" if rnd.random() < 0.3 else "in-progress",
+        })
+    yield "projects", projects
+    start = datetime.now() - timedelta(days=730)
+
+    def day():
+        return (start + timedelta(days=rnd.randrange(731))).strftime("%Y-%m-%d")
+
+    yield "expenses", [
+        {"id": i, "project_id": rnd.randint(1, n_projects), "amount": round(rnd.uniform(100, 50000), 2),
+         "description": rnd.choice(["Material", "Labour", "Transport", "Rent", "Tools"]), "date": day()}
+        for i in range(1, rows + 1)
+    ]
+    progress = []
+    for i in range(1, rows + 1):
+        project = projects[rnd.randrange(n_projects)]
+        progress.append({"id": i, "project_id": project["id"], "update": f"Update {i}", "date": day(),
+                         "user": rnd.choice(project["users"]), "instructions": ""})
+    yield "progress", progress
+    del progress
+    messages = []
+    for i in range(1, rows + 1):
+        # A fifth of all messages are between user0 and user1
+        if rnd.random() < 0.2:
+            sender, receiver = rnd.sample(["user0", "user1"], 2)
+        else:
+            sender, receiver = rnd.sample(names, 2)
+        stamp = start + timedelta(seconds=i * 60)
+        messages.append({"id": i, "sender": sender, "receiver": receiver, "message": f"Message {i}",
+                         "timestamp": stamp.strftime("%Y-%m-%d %H:%M:%S"), "read": rnd.random() < 0.9})
+    yield "messages", messages
+    del messages
+    yield "misc_expenses", [
+        {"id": i, "date": day(), "user": rnd.choice(names), "description": rnd.choice(["Tea", "Fuel", "Stationery"]),
+         "amount": round(rnd.uniform(50, 5000), 2), "paid_by": rnd.choice(names), "remarks": ""}
+        for i in range(1, rows + 1)
+    ]
+
+
+# Left in every directory seed() fills; only such a directory (or an empty
+# one) is wiped by the next seed unless force is given
+SEED_MARKER = ".bench-data"
+
+
+def seed(data_dir, db_path, backend, rows, force=False):
+    if os.path.exists(data_dir):
+        if os.listdir(data_dir) and not force and not os.path.exists(os.path.join(data_dir, SEED_MARKER)):
+            raise SystemExit(
+                f"{data_dir} holds data that bench.py did not seed; "
+                "pick another --data-dir or pass --force to replace it"
+            )
+        shutil.rmtree(data_dir)
+    os.makedirs(data_dir)
+    open(os.path.join(data_dir, SEED_MARKER), "w").close()
+    storage = None
+    if backend == "sqlite":
+        sys.path.insert(0, BASE_DIR)
+        from storage import SqliteStorage
+        storage = SqliteStorage(db_path)
+    counts = {}
+    for name, records in synthetic_data(rows):
+        with open(os.path.join(data_dir, f"{name}.json"), "w") as f:
+            json.dump(records, f)
+        if storage is not None:
+            storage.replace(name, records)
+        counts[name] = len(records)
+    return counts
+
+# -------------------- Routes Under Test --------------------
+# name -> (method, path, form); all run as user0, chatting with user1
+ROUTES = {
+    "dashboard": ("GET", "/dashboard", None),
+    "project_detail": ("GET", "/project/1", None),
+    "view_misc_expense": ("GET", "/misc/view?previous=true", None),
+    "chat_with": ("GET", "/messages/user1", None),
+    "send_message": ("POST", "/messages/send", {"receiver": "user1", "message": "benchmark"}),
+    "unread_details": ("GET", "/messages/unread_details", None),
+}
+
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[max(math.ceil(p * len(ordered)) - 1, 0)]
+
+
+def summarize(latencies, errors, wall, rss_kb):
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3),
+        "throughput_rps": round(len(latencies) / wall, 1),
+        "peak_rss_kb": rss_kb,
+    }
+
+# -------------------- Test Client Driver --------------------
+def run_client(env, requests, warmup):
+    os.environ.update(env)
+    sys.path.insert(0, BASE_DIR)
+    import app as bench_app
+    client = bench_app.app.test_client()
+    client.post("/", data={"username": "user0", "password": PASSWORD})
+    results = {}
+    for name, (method, path, form) in ROUTES.items():
+        for _ in range(warmup):
+            client.open(path, method=method, data=form)
+        latencies, errors = [], 0
+        began = time.perf_counter()
+        for _ in range(requests):
+            t = time.perf_counter()
+            response = client.open(path, method=method, data=form)
+            latencies.append(time.perf_counter() - t)
+            errors += response.status_code >= 400
+        wall = time.perf_counter() - began
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource is not None else None
+        results[name] = summarize(latencies, errors, wall, rss)
+        print(f"{name:18} {results[name]}")
+    return results
+
+# -------------------- Gunicorn Driver --------------------
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def process_tree_hwm_kb(pid):
+    # Sum of peak RSS (VmHWM) of the gunicorn master and its workers; Linux only
+    pids = [pid]
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            pids += [int(p) for p in f.read().split()]
+        total = 0
+        for p in pids:
+            with open(f"/proc/{p}/status") as f:
+                total += next(int(line.split()[1]) for line in f if line.startswith("VmHWM:"))
+        return total
+    except (OSError, StopIteration):
+        return None
+
+
+def logged_in_opener(base):
+    opener = urllib.request.build_opener(
+        urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), NoRedirect()
+    )
+    body = urllib.parse.urlencode({"username": "user0", "password": PASSWORD}).encode()
+    try:
+        opener.open(base + "/", body)
+    except urllib.error.HTTPError as e:
+        if e.code != 302:
+            raise
+    return opener
+
+
+def timed_request(opener, base, method, path, form):
+    body = urllib.parse.urlencode(form).encode() if form is not None else None
+    t = time.perf_counter()
+    try:
+        with opener.open(urllib.request.Request(base + path, data=body, method=method)) as response:
+            response.read()
+        failed = False
+    except urllib.error.HTTPError as e:
+        e.read()
+        failed = e.code >= 400
+    return time.perf_counter() - t, failed
+
+
+def run_gunicorn(env, requests, warmup, workers, concurrency):
+    port = free_port()
+    base = f"http://127.0.0.1:{port}"
+    server = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-w", str(workers), "-b", f"127.0.0.1:{port}", "app:app"],
+        cwd=BASE_DIR, env={**os.environ, **env}, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        deadline = time.monotonic() + 60
+        while True:
+            try:
+                urllib.request.urlopen(base + "/", timeout=1).read()
+                break
+            except OSError:
+                if server.poll() is not None or time.monotonic() > deadline:
+                    raise SystemExit("gunicorn did not start")
+                time.sleep(0.2)
+        local = threading.local()
+
+        def opener():
+            if not hasattr(local, "opener"):
+                local.opener = logged_in_opener(base)
+            return local.opener
+
+        results = {}
+        with ThreadPoolExecutor(concurrency) as pool:
+            for name, (method, path, form) in ROUTES.items():
+                list(pool.map(lambda _: timed_request(opener(), base, method, path, form), range(warmup)))
+                began = time.perf_counter()
+                samples = list(pool.map(lambda _: timed_request(opener(), base, method, path, form), range(requests)))
+                wall = time.perf_counter() - began
+                latencies = [s[0] for s in samples]
+                errors = sum(s[1] for s in samples)
+                results[name] = summarize(latencies, errors, wall, process_tree_hwm_kb(server.pid))
+                print(f"{name:18} {results[name]}")
+        return results
+    finally:
+        server.terminate()
+        server.wait()
+
+# -------------------- Compare --------------------
+def compare(before_path, after_path):
+    with open(before_path) as f:
+        before = json.load(f)["routes"]
+    with open(after_path) as f:
+        after = json.load(f)["routes"]
+    print(f"{'route':18} {'p50 ms':>18} {'p99 ms':>18} {'rps':>18}")
+    for name in before:
+        if name not in after:
+            continue
+        cells = []
+        for key in ("p50_ms", "p99_ms", "throughput_rps"):
+            a, b = before[name][key], after[name][key]
+            change = (b - a) / a * 100 if a else 0
+            cells.append(f"{a:>7} -> {b:<7} {change:+.0f}%")
+        print(f"{name:18} " + " ".join(cells))
+
+# -------------------- CLI --------------------
+def main():
+    parser = argparse.ArgumentParser(description="Seed synthetic data and benchmark the main routes.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    for command in ("seed", "run"):
+        p = commands.add_parser(command)
+        p.add_argument("--scale", default="1k", help="rows per collection: 1k, 100k, 1m or a number")
+        p.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "softcentric-bench"))
+        p.add_argument("--backend", choices=["json", "sqlite"], default="json")
+        p.add_argument("--format", choices=["json", "compact", "jsonl", "marshal"], default="json",
+                       help="file format of the json backend")
+        p.add_argument("--force", action="store_true",
+                       help="seed even if --data-dir holds data bench.py did not create (it is deleted)")
+    run = commands.choices["run"]
+    run.add_argument("--mode", choices=["client", "gunicorn"], default="client")
+    run.add_argument("--requests", type=int, default=200, help="measured requests per route")
+    run.add_argument("--warmup", type=int, default=10)
+    run.add_argument("--workers", type=int, default=4, help="gunicorn workers")
+    run.add_argument("--concurrency", type=int, default=8, help="client threads against gunicorn")
+    run.add_argument("--no-seed", action="store_true", help="reuse the data already in --data-dir")
+    run.add_argument("--out", default="bench-results.json")
+    cmp = commands.add_parser("compare")
+    cmp.add_argument("before")
+    cmp.add_argument("after")
+    args = parser.parse_args()
+
+    if args.command == "compare":
+        compare(args.before, args.after)
+        return
+    rows = parse_scale(args.scale)
+    db_path = os.path.join(args.data_dir, "bench.db")
+    env = {"DATA_DIR": args.data_dir, "DATABASE": db_path, "STORAGE_BACKEND": args.backend, "STORAGE_FORMAT": args.format}
+    if args.command == "seed" or not args.no_seed:
+        began = time.perf_counter()
+        counts = seed(args.data_dir, db_path, args.backend, rows, args.force)
+        print(f"seeded {counts} in {time.perf_counter() - began:.1f}s")
+    if args.command == "seed":
+        return
+    if args.mode == "client":
+        routes = run_client(env, args.requests, args.warmup)
+    else:
+        routes = run_gunicorn(env, args.requests, args.warmup, args.workers, args.concurrency)
+    report = {
+        "meta": {
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "scale": rows,
+            "backend": args.backend,
+            "format": args.format,
+            "mode": args.mode,
+            "requests": args.requests,
+            "workers": args.workers if args.mode == "gunicorn" else 1,
+            "concurrency": args.concurrency if args.mode == "gunicorn" else 1,
+            "python": platform.python_version(),
+        },
+        "routes": routes,
+    }
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=4)
+    print(f"results written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+import threading
+from collections import OrderedDict
+
+# -------------------- Fragment Cache --------------------
+# Rendered HTML of page fragments, keyed by (fragment, scope, versions of the
+# collections it reads). Any write moves a version on, so the next request
+# misses and renders afresh; notifications from this process also drop the
+# stale entries right away instead of leaving them to LRU eviction. Writes
+# made by other workers only show up through the versions.
+class FragmentCache:
+    def __init__(self, storage, max_entries=512, max_bytes=16 * 1024 * 1024):
+        self.storage = storage
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.watched = set()
+        self.hits = self.misses = self.evictions = 0
+
+    def _watch(self, name):
+        with self.lock:
+            if name in self.watched:
+                return
+            self.watched.add(name)
+        self.storage.watch(name, lambda changes, before, after: self.invalidate(name))
+
+    def invalidate(self, name):
+        with self.lock:
+            for key in [k for k, (collections, _) in self.entries.items() if name in collections]:
+                self._drop(key)
+
+    def _drop(self, key):
+        _, html = self.entries.pop(key)
+        self.bytes -= len(html)
+
+    def get(self, fragment, scope, collections, render):
+        # render() loads the data and returns the HTML, or None for nothing
+        # worth keeping; it only runs on a miss
+        for name in collections:
+            self._watch(name)
+        key = (fragment, scope, tuple(self.storage.version(name) for name in collections))
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        # Versions were read before the data, so a write racing the render can
+        # only leave newer data under an older key, which is never asked for
+        html = render()
+        if html is None:
+            return None
+        with self.lock:
+            if key in self.entries:
+                self._drop(key)
+            self.entries[key] = (set(collections), html)
+            self.bytes += len(html)
+            while self.entries and (len(self.entries) > self.max_entries or self.bytes > self.max_bytes):
+                self._drop(next(iter(self.entries)))
+                self.evictions += 1
+        return html
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": round(self.hits / total, 3) if total else 0.0,
+            }
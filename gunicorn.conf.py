@@ -0,0 +1,11 @@
+import os
+
+# /messages/poll holds a request open for up to POLL_TIMEOUT seconds for every
+# open tab, so each worker serves requests from a pool of threads; with sync
+# workers one waiting tab would hold up every other page behind it
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", "32"))
+
+# PRELOAD=1 imports the app once in the master, so the workers share its warm
+# data instead of each loading it (see preload() in app.py)
+preload_app = os.environ.get("PRELOAD") == "1"
@@ -0,0 +1,400 @@
+import json
+import threading
+
+from archive import MESSAGE_ORDER, pair_key
+from storage import page_rows, sort_key
+
+# -------------------- Derived Indexes --------------------
+# An index is built once from storage and then kept current by the change
+# notifications of every write (see Storage.watch), so lookups never touch
+# storage. Writes of other workers are replayed from the storage's change
+# log where it keeps one (SQLite; the JSON message log replays them as
+# notifications). If a change was missed - another worker rewrote a
+# whole-file collection, or the changes do not line up with the version the
+# index was built at - the index is rebuilt on its next use.
+class DerivedIndex:
+    collection = None
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.lock = threading.RLock()
+        self.state = None
+        self.version = None
+        self.rebuilds = 0
+        storage.watch(self.collection, self._on_change)
+
+    def empty(self):
+        raise NotImplementedError
+
+    def add(self, state, row):
+        raise NotImplementedError
+
+    def remove(self, state, row):
+        raise NotImplementedError
+
+    def rows(self):
+        return self.storage.all(self.collection)
+
+    def _on_change(self, changes, before, after):
+        with self.lock:
+            if self.version == after:
+                # Already replayed from the change log
+                return
+            if changes is None or self.state is None or self.version != before:
+                self.version = None
+                return
+            for old, new in changes:
+                if old is not None:
+                    self.remove(self.state, old)
+                if new is not None:
+                    self.add(self.state, new)
+            self.version = after
+
+    def ensure(self):
+        if self.version is not None:
+            if self.storage.version(self.collection) == self.version or self._catch_up():
+                return self.state
+        with self.storage.consistent(self.collection) as version:
+            state = self.empty()
+            for row in self.rows():
+                self.add(state, row)
+            with self.lock:
+                self.state = state
+                self.version = version
+                self.rebuilds += 1
+        return state
+
+    def _catch_up(self):
+        with self.lock:
+            if self.version is None:
+                return False
+            changes = self.storage.changes(self.collection, self.version)
+            if changes is None:
+                return False
+            for batch, before, after in changes:
+                self._on_change(batch, before, after)
+            return self.version is not None
+
+# -------------------- Unread Messages --------------------
+def _is_unread(message):
+    return message is not None and not message.get("read", False)
+
+
+def _message_key(message):
+    return (message.get("id"), message.get("sender"), message.get("timestamp"), message.get("message"))
+
+
+class UnreadIndex(DerivedIndex):
+    collection = "messages"
+
+    def empty(self):
+        # totals: receiver -> count, by_pair: receiver -> sender -> [messages]
+        return {"totals": {}, "by_pair": {}}
+
+    def rows(self):
+        return self.storage.find("messages", read=False)
+
+    def add(self, state, message):
+        if not _is_unread(message):
+            return
+        receiver, sender = message["receiver"], message["sender"]
+        state["by_pair"].setdefault(receiver, {}).setdefault(sender, []).append(dict(message))
+        state["totals"][receiver] = state["totals"].get(receiver, 0) + 1
+
+    def remove(self, state, message):
+        if not _is_unread(message):
+            return
+        receiver, sender = message["receiver"], message["sender"]
+        pending = state["by_pair"].get(receiver, {}).get(sender, [])
+        key = _message_key(message)
+        for i, m in enumerate(pending):
+            if _message_key(m) == key:
+                del pending[i]
+                break
+        else:
+            return
+        if not pending:
+            del state["by_pair"][receiver][sender]
+        state["totals"][receiver] -= 1
+
+    def count(self, receiver):
+        return self.ensure()["totals"].get(receiver, 0)
+
+    def by_sender(self, receiver):
+        pairs = self.ensure()["by_pair"].get(receiver, {})
+        return {sender: len(msgs) for sender, msgs in pairs.items()}
+
+    def messages(self, receiver):
+        pairs = self.ensure()["by_pair"].get(receiver, {})
+        unread = [dict(m) for msgs in list(pairs.values()) for m in msgs]
+        unread.sort(key=lambda m: m.get("timestamp", ""))
+        return unread
+
+# -------------------- Grouping Indexes --------------------
+# key -> {id: row}, so a filter view only touches the rows it shows. A row can
+# sit under several keys (a project under each of its users).
+def _row_id(row):
+    # Early messages carry no id; their content identifies them instead
+    if row.get("id") is not None:
+        return row["id"]
+    return json.dumps(row, sort_keys=True, default=str)
+
+
+class GroupIndex(DerivedIndex):
+    def keys_of(self, row):
+        raise NotImplementedError
+
+    def empty(self):
+        return {}
+
+    def add(self, state, row):
+        for key in self.keys_of(row):
+            state.setdefault(key, {})[_row_id(row)] = dict(row)
+
+    def remove(self, state, row):
+        for key in self.keys_of(row):
+            bucket = state.get(key)
+            if bucket is not None and bucket.pop(_row_id(row), None) is not None and not bucket:
+                del state[key]
+
+    def get(self, *keys):
+        state = self.ensure()
+        with self.lock:
+            rows = [dict(r) for key in keys for r in state.get(key, {}).values()]
+        rows.sort(key=lambda r: sort_key(r, ("id",)))
+        return rows
+
+    def page(self, key, order_by, limit, before=None):
+        # Like Storage.page over one bucket; copies only the page
+        state = self.ensure()
+        with self.lock:
+            rows = page_rows(list(state.get(key, {}).values()), order_by, limit, before)
+            return [dict(r) for r in rows]
+
+    def size(self, *keys):
+        state = self.ensure()
+        with self.lock:
+            return sum(len(state.get(key, ())) for key in keys)
+
+    def keys(self):
+        state = self.ensure()
+        with self.lock:
+            return list(state)
+
+
+class ExpensesByProject(GroupIndex):
+    collection = "expenses"
+
+    def keys_of(self, row):
+        return [row.get("project_id")]
+
+
+class ProgressByProject(GroupIndex):
+    collection = "progress"
+
+    def keys_of(self, row):
+        return [row.get("project_id")]
+
+
+class MiscByUser(GroupIndex):
+    collection = "misc_expenses"
+
+    def keys_of(self, row):
+        return [row.get("user")]
+
+
+class MiscByMonth(GroupIndex):
+    collection = "misc_expenses"
+
+    def keys_of(self, row):
+        return [row.get("date", "")[:7]]
+
+
+class Conversations(GroupIndex):
+    # Live messages of each pair of users, both directions in one bucket
+    collection = "messages"
+
+    def keys_of(self, row):
+        return [pair_key(row.get("sender"), row.get("receiver"))]
+
+
+class ProjectsByUser(GroupIndex):
+    collection = "projects"
+
+    def keys_of(self, row):
+        return row.get("users") or []
+
+    def project_ids(self, username):
+        # Bucket keys are the project ids; no rows are copied
+        state = self.ensure()
+        with self.lock:
+            return set(state.get(username, ()))
+
+    def member(self, username, project_id):
+        state = self.ensure()
+        with self.lock:
+            return project_id in state.get(username, ())
+
+# -------------------- Accounts --------------------
+# Users by username for login and password checks, so neither scans the
+# users collection. Adding, renaming and deleting users reach it through the
+# users notifications like every other index.
+class Accounts(DerivedIndex):
+    collection = "users"
+
+    def empty(self):
+        return {}
+
+    def add(self, state, row):
+        state[row.get("username")] = dict(row)
+
+    def remove(self, state, row):
+        user = state.get(row.get("username"))
+        if user is not None and _row_id(user) == _row_id(row):
+            del state[row.get("username")]
+
+    def get(self, username):
+        state = self.ensure()
+        with self.lock:
+            user = state.get(username)
+            return dict(user) if user is not None else None
+
+# -------------------- Misc Expense Summary --------------------
+# Dropdown options of the misc expense page as refcounted distinct values,
+# plus per-month totals broken down by (user, paid_by). Any month/user/paid_by
+# filter is answered from a handful of cells instead of every expense.
+SUMMARY_FIELDS = ("user", "description", "paid_by", "month")
+
+
+def _summary_values(row):
+    return {
+        "user": row.get("user"),
+        "description": row.get("description"),
+        "paid_by": row.get("paid_by") or None,
+        "month": row.get("date", "")[:7] or None,
+    }
+
+
+class MiscSummary(DerivedIndex):
+    collection = "misc_expenses"
+
+    def empty(self):
+        # values: field -> value -> refcount, cells: month -> (user, paid_by) -> [count, total]
+        return {"values": {field: {} for field in SUMMARY_FIELDS}, "cells": {}}
+
+    def add(self, state, row):
+        values = _summary_values(row)
+        for field, value in values.items():
+            if value is not None:
+                counts = state["values"][field]
+                counts[value] = counts.get(value, 0) + 1
+        cell = state["cells"].setdefault(values["month"], {}).setdefault((values["user"], values["paid_by"]), [0, 0.0])
+        cell[0] += 1
+        cell[1] += float(row.get("amount") or 0)
+
+    def remove(self, state, row):
+        values = _summary_values(row)
+        for field, value in values.items():
+            counts = state["values"][field]
+            if value in counts:
+                counts[value] -= 1
+                if not counts[value]:
+                    del counts[value]
+        cells = state["cells"].get(values["month"], {})
+        cell = cells.get((values["user"], values["paid_by"]))
+        if cell is None:
+            return
+        cell[0] -= 1
+        cell[1] -= float(row.get("amount") or 0)
+        if not cell[0]:
+            del cells[(values["user"], values["paid_by"])]
+            if not cells:
+                del state["cells"][values["month"]]
+
+    def options(self, field):
+        state = self.ensure()
+        with self.lock:
+            return list(state["values"][field])
+
+    def total(self, months, user=None, paid_by=None):
+        state = self.ensure()
+        amount = 0.0
+        with self.lock:
+            for month in months:
+                for (cell_user, cell_paid_by), (_, cell_total) in state["cells"].get(month, {}).items():
+                    if (user is None or cell_user == user) and (paid_by is None or cell_paid_by == paid_by):
+                        amount += cell_total
+        # Running sums drift by float rounding; amounts carry two decimals
+        return round(amount, 2)
+
+# -------------------- Inbox Summary --------------------
+# user -> counterpart -> {"count": live messages, "last": preview of the
+# newest one}, so the inbox lists conversations without reading any thread.
+# When the newest message of a conversation goes away its preview is taken
+# again from the conversation index the next time that inbox is read.
+PREVIEW_LENGTH = 80
+
+
+def message_preview(message):
+    return {
+        "key": _row_id(message),
+        "sender": message.get("sender"),
+        "message": (message.get("message") or "")[:PREVIEW_LENGTH],
+        "timestamp": message.get("timestamp"),
+        "id": message.get("id"),
+    }
+
+
+class Inbox(DerivedIndex):
+    collection = "messages"
+
+    def __init__(self, storage, conversations):
+        self.conversations = conversations
+        super().__init__(storage)
+
+    def empty(self):
+        return {}
+
+    def _sides(self, message):
+        sender, receiver = message.get("sender"), message.get("receiver")
+        return {(sender, receiver), (receiver, sender)}
+
+    def add(self, state, message):
+        preview = message_preview(message)
+        for user, other in self._sides(message):
+            entry = state.setdefault(user, {}).setdefault(other, {"count": 0, "last": None})
+            entry["count"] += 1
+            last = entry["last"]
+            if last is None:
+                # Marking the newest message read removes and re-adds it
+                if entry["count"] == 1 or entry.get("removed") == preview["key"]:
+                    entry["last"] = preview
+            elif sort_key(preview, MESSAGE_ORDER) >= sort_key(last, MESSAGE_ORDER):
+                entry["last"] = preview
+
+    def remove(self, state, message):
+        key = _row_id(message)
+        for user, other in self._sides(message):
+            entry = state.get(user, {}).get(other)
+            if entry is None:
+                continue
+            entry["count"] -= 1
+            if not entry["count"]:
+                del state[user][other]
+            elif entry["last"] is not None and entry["last"]["key"] == key:
+                entry["last"], entry["removed"] = None, key
+
+    def threads(self, user):
+        # counterpart -> preview of the newest live message
+        state = self.ensure()
+        with self.lock:
+            entries = list(state.get(user, {}).items())
+        threads = {}
+        for other, entry in entries:
+            if entry["last"] is None:
+                newest = self.conversations.page(pair_key(user, other), MESSAGE_ORDER, 1)
+                if not newest:
+                    continue
+                entry["last"] = message_preview(newest[0])
+            threads[other] = dict(entry["last"])
+        return threads
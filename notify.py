@@ -0,0 +1,60 @@
+import hashlib
+import os
+import threading
+import time
+
+from storage import file_lock, replace_file
+
+# -------------------- Notification Sequences --------------------
+# One small file per user holds a counter that is bumped whenever something
+# that user should be told about happens (a new message, a read receipt).
+# Waiters in the writing worker are woken at once through a Condition; other
+# gunicorn workers see the change on their next stat() of the file, which is
+# all an idle long-poll costs.
+class Notifier:
+    def __init__(self, directory, interval=0.5):
+        self.directory = directory
+        self.interval = interval
+        self.cond = threading.Condition()
+
+    def path(self, user):
+        digest = hashlib.sha1(user.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, f"{digest}.seq")
+
+    def sequence(self, user):
+        try:
+            with open(self.path(user), "r") as f:
+                return int(f.read() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def bump(self, user):
+        path = self.path(user)
+        os.makedirs(self.directory, exist_ok=True)
+        with file_lock(os.path.join(self.directory, "notify")):
+            seq = self.sequence(user) + 1
+            replace_file(path, lambda f: f.write(str(seq)))
+        with self.cond:
+            self.cond.notify_all()
+        return seq
+
+    def wait(self, user, since, timeout):
+        deadline = time.monotonic() + timeout
+        path = self.path(user)
+        seen = False
+        while True:
+            try:
+                st = os.stat(path)
+                stamp = (st.st_mtime_ns, st.st_ino)
+            except FileNotFoundError:
+                stamp = None
+            if stamp != seen:
+                seen = stamp
+                seq = self.sequence(user)
+                if seq != since:
+                    return seq
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return seq
+            with self.cond:
+                self.cond.wait(min(self.interval, remaining))
@@ -0,0 +1,206 @@
+import cProfile
+import hmac
+import os
+import random
+import threading
+import time
+from functools import wraps
+
+from flask import Response, abort, before_render_template, g, has_request_context, request, session, template_rendered
+
+import storage as storage_module
+
+# -------------------- Request Profiling --------------------
+# Opt-in (PROFILE=1). Each request is broken down into storage calls, JSON
+# parse/serialize, context processors and template rendering. The breakdown
+# goes out as a Server-Timing header and into per-process counters served in
+# Prometheus text format at /metrics; with several gunicorn workers every
+# worker reports its own counters. PROFILE_SAMPLE_RATE runs cProfile on that
+# fraction of requests and dumps the stats to PROFILE_DIR per endpoint.
+# /metrics answers logged-in admins only, or a scraper that sends
+# "Authorization: Bearer <METRICS_TOKEN>" when that token is set.
+STORAGE_READS = ("get", "find", "all", "count", "page", "distinct", "total")
+STORAGE_WRITES = ("insert", "insert_many", "bulk_insert", "update", "delete", "replace")
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+PREFIX = "softcentric"
+
+HELP = {
+    "request_seconds": ("histogram", "Request duration by endpoint"),
+    "storage_seconds": ("counter", "Time spent in storage calls"),
+    "storage_calls": ("counter", "Storage calls"),
+    "storage_rows": ("counter", "Rows returned or changed by storage calls"),
+    "io_seconds": ("counter", "Time spent parsing and serializing collection files"),
+    "io_bytes": ("counter", "Bytes parsed and serialized"),
+    "context_processor_seconds": ("counter", "Time spent in template context processors"),
+    "render_seconds": ("counter", "Time spent rendering templates"),
+}
+
+
+def _rows(op, result):
+    if isinstance(result, bool) or result is None:
+        return 0
+    if isinstance(result, int):
+        return result if op in STORAGE_WRITES else 1
+    if isinstance(result, dict):
+        return 1
+    if hasattr(result, "__len__"):
+        return len(result)
+    return 1
+
+
+def _sample(value):
+    # Exact: a rounded counter stops moving once it is large, and rate() reads 0
+    return str(value) if isinstance(value, int) else repr(float(value))
+
+
+def _metric_order(item):
+    # Histogram buckets in numeric order, +Inf last
+    (name, labels), _ = item
+    return name, [(k, float(v) if k == "le" else 0.0, v) for k, v in labels]
+
+
+class Profiler:
+    def __init__(self, app, storage, sample_rate=0.0, profile_dir=None, token=None):
+        self.lock = threading.Lock()
+        self.values = {}
+        self.local = threading.local()
+        self.sample_rate = sample_rate
+        self.profile_dir = profile_dir
+        self.token = token
+        if sample_rate and profile_dir:
+            os.makedirs(profile_dir, exist_ok=True)
+        self.instrument(storage)
+        processors = app.template_context_processors[None]
+        processors[:] = [self._timed_processor(fn) for fn in processors]
+        storage_module.io_observers.append(self._on_io)
+        before_render_template.connect(self._before_render, app)
+        template_rendered.connect(self._after_render, app)
+        app.before_request(self._start)
+        app.after_request(self._finish)
+        app.teardown_request(self._stop_cprofile)
+        app.add_url_rule("/metrics", "metrics", self.metrics)
+
+    def instrument(self, storage):
+        for op in STORAGE_READS + STORAGE_WRITES:
+            setattr(storage, op, self._timed_storage(op, getattr(storage, op)))
+
+    # ---- counters
+    def add(self, name, labels, value):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def _request_add(self, part, seconds):
+        if has_request_context() and "_profile" in g:
+            g._profile[part] = g._profile.get(part, 0.0) + seconds
+
+    # ---- instrumentation
+    def _timed_storage(self, op, method):
+        @wraps(method)
+        def timed(name, *args, **kwargs):
+            # Only the outermost call counts; get() goes through find()
+            depth = getattr(self.local, "depth", 0)
+            self.local.depth = depth + 1
+            started = time.perf_counter()
+            try:
+                result = method(name, *args, **kwargs)
+            finally:
+                self.local.depth = depth
+            if depth:
+                return result
+            seconds = time.perf_counter() - started
+            labels = {"op": op, "collection": name}
+            self.add("storage_seconds", labels, seconds)
+            self.add("storage_calls", labels, 1)
+            self.add("storage_rows", labels, _rows(op, result))
+            self._request_add("storage", seconds)
+            return result
+        return timed
+
+    def _timed_processor(self, fn):
+        @wraps(fn)
+        def timed():
+            started = time.perf_counter()
+            try:
+                return fn()
+            finally:
+                seconds = time.perf_counter() - started
+                self.add("context_processor_seconds", {"processor": fn.__name__}, seconds)
+                self._request_add("context", seconds)
+        return timed
+
+    def _on_io(self, kind, file, seconds, nbytes):
+        labels = {"kind": kind, "file": os.path.basename(file)}
+        self.add("io_seconds", labels, seconds)
+        self.add("io_bytes", labels, nbytes)
+        self._request_add(kind, seconds)
+
+    def _before_render(self, sender, template, context, **extra):
+        self.local.render_started = time.perf_counter()
+
+    def _after_render(self, sender, template, context, **extra):
+        started = getattr(self.local, "render_started", None)
+        if started is None:
+            return
+        seconds = time.perf_counter() - started
+        self.add("render_seconds", {"template": template.name or "-"}, seconds)
+        self._request_add("render", seconds)
+
+    # ---- request lifecycle
+    def _start(self):
+        g._profile = {"started": time.perf_counter()}
+        if self.sample_rate and self.profile_dir and random.random() < self.sample_rate:
+            g._cprofile = cProfile.Profile()
+            g._cprofile.enable()
+
+    def _finish(self, response):
+        profile = g.pop("_profile", None)
+        if profile is None:
+            return response
+        total = time.perf_counter() - profile.pop("started")
+        endpoint = request.endpoint or "-"
+        for bound in REQUEST_BUCKETS:
+            self.add("request_seconds_bucket", {"endpoint": endpoint, "le": str(bound)}, int(total <= bound))
+        self.add("request_seconds_bucket", {"endpoint": endpoint, "le": "+Inf"}, 1)
+        self.add("request_seconds_sum", {"endpoint": endpoint}, total)
+        self.add("request_seconds_count", {"endpoint": endpoint}, 1)
+        timings = [f"{part};dur={seconds * 1000:.2f}" for part, seconds in profile.items()]
+        timings.append(f"total;dur={total * 1000:.2f}")
+        response.headers["Server-Timing"] = ", ".join(timings)
+        return response
+
+    def _stop_cprofile(self, exc):
+        profiler = g.pop("_cprofile", None)
+        if profiler is None:
+            return
+        profiler.disable()
+        name = f"{request.endpoint or 'unknown'}-{time.time_ns()}.prof"
+        profiler.dump_stats(os.path.join(self.profile_dir, name))
+
+    # ---- exposition
+    def render(self):
+        with self.lock:
+            values = sorted(self.values.items(), key=_metric_order)
+        lines, described = [], set()
+        for (name, labels), value in values:
+            family = name.rsplit("_", 1)[0] if name.startswith("request_seconds_") else name
+            if family not in described:
+                kind, text = HELP[family]
+                lines.append(f"# HELP {PREFIX}_{family} {text}")
+                lines.append(f"# TYPE {PREFIX}_{family} {kind}")
+                described.add(family)
+            suffix = "_total" if HELP[family][0] == "counter" else ""
+            label_text = ",".join(f'{k}="{v}"' for k, v in labels)
+            lines.append(f"{PREFIX}_{name}{suffix}{{{label_text}}} {_sample(value)}")
+        return "\n".join(lines) + "\n"
+
+    def allowed(self):
+        if session.get("role") == "admin":
+            return True
+        sent = request.headers.get("Authorization", "")
+        return bool(self.token) and hmac.compare_digest(sent.encode(), f"Bearer {self.token}".encode())
+
+    def metrics(self):
+        if not self.allowed():
+            abort(403)
+        return Response(self.render(), mimetype="text/plain; version=0.0.4")
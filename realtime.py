@@ -0,0 +1,249 @@
+import asyncio
+import json
+from urllib.parse import parse_qsl
+
+from werkzeug.http import parse_cookie
+
+# -------------------- Realtime Chat (ASGI) --------------------
+# An asyncio chat path served next to the Flask app (see asgi.py): the proxy
+# sends <prefix>/... here and everything else to gunicorn. It shares the Flask
+# session cookie, so a logged-in browser needs nothing extra.
+#   POST <prefix>/send    {"receiver", "message"} as JSON or a form
+#   GET  <prefix>/stream  Server-Sent Events for the logged-in user
+# A send is queued; one writer task stores the queue with a single
+# insert_many per batch, and only then pushes each message to every open
+# stream of its receiver (and the sender's other tabs) and answers the send,
+# so nobody is shown a message that failed to store. Changes made through
+# the Flask workers (messages sent there, read receipts) reach open streams
+# through the notifier's per-user sequences.
+HEARTBEAT = 15
+STREAM_QUEUE = 256
+MAX_BODY = 64 * 1024
+
+
+class ChatApp:
+    def __init__(self, flask_app, storage, notifier, unread_index, new_message, prefix="/chat",
+                 batch_size=500, flush_interval=0.02, watch_interval=0.5):
+        self.flask_app = flask_app
+        self.storage = storage
+        self.notifier = notifier
+        self.unread_index = unread_index
+        self.new_message = new_message
+        self.prefix = prefix
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.watch_interval = watch_interval
+        self.streams = {}  # user -> set of queues
+        self.sequences = {}  # user -> last notifier sequence sent out
+        self.pending = []  # (message, future) waiting for the writer
+        self.wakeup = None
+        self.tasks = []
+
+    # ---- ASGI entry point
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self._lifespan(receive, send)
+        if scope["type"] != "http":
+            return
+        if not self.tasks:
+            self._start()
+        path = scope["path"]
+        if path == f"{self.prefix}/send" and scope["method"] == "POST":
+            return await self._send(scope, receive, send)
+        if path == f"{self.prefix}/stream" and scope["method"] == "GET":
+            return await self._stream(scope, receive, send)
+        await self._respond(send, 404, {"error": "not found"})
+
+    async def _lifespan(self, receive, send):
+        while True:
+            event = await receive()
+            if event["type"] == "lifespan.startup":
+                self._start()
+                await send({"type": "lifespan.startup.complete"})
+            elif event["type"] == "lifespan.shutdown":
+                await self._flush()
+                for task in self.tasks:
+                    task.cancel()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def _start(self):
+        self.wakeup = asyncio.Event()
+        self.tasks = [asyncio.create_task(self._writer()), asyncio.create_task(self._watcher())]
+
+    # ---- helpers
+    def _user(self, scope):
+        # Username from the signed Flask session cookie, or None
+        headers = dict(scope["headers"])
+        cookies = parse_cookie(headers.get(b"cookie", b"").decode("latin-1"))
+        value = cookies.get(self.flask_app.config["SESSION_COOKIE_NAME"])
+        serializer = self.flask_app.session_interface.get_signing_serializer(self.flask_app)
+        if not value or serializer is None:
+            return None
+        try:
+            data = serializer.loads(value, max_age=int(self.flask_app.permanent_session_lifetime.total_seconds()))
+        except Exception:
+            return None
+        return data.get("username")
+
+    async def _respond(self, send, status, data):
+        body = json.dumps(data, separators=(",", ":")).encode("utf-8")
+        await send({"type": "http.response.start", "status": status,
+                    "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]})
+        await send({"type": "http.response.body", "body": body})
+
+    async def _body(self, receive):
+        body = b""
+        while True:
+            event = await receive()
+            if event["type"] == "http.disconnect":
+                return None
+            body += event.get("body", b"")
+            if len(body) > MAX_BODY:
+                return None
+            if not event.get("more_body"):
+                return body
+
+    def _publish(self, user, event, data):
+        # Encoded once, however many streams the user has open
+        frame = f"event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+        for queue in list(self.streams.get(user, ())):
+            try:
+                queue.put_nowait(frame)
+            except asyncio.QueueFull:
+                # A stream that stopped reading is closed; the browser
+                # reconnects and catches up from storage
+                self.streams[user].discard(queue)
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+
+    # ---- sending
+    async def _send(self, scope, receive, send):
+        sender = self._user(scope)
+        if sender is None:
+            return await self._respond(send, 401, {"error": "login required"})
+        body = await self._body(receive)
+        if body is None:
+            return await self._respond(send, 413, {"error": "request too large"})
+        headers = dict(scope["headers"])
+        try:
+            if headers.get(b"content-type", b"").startswith(b"application/json"):
+                fields = json.loads(body)
+            else:
+                fields = dict(parse_qsl(body.decode("utf-8")))
+        except ValueError:
+            fields = None
+        if not isinstance(fields, dict):
+            return await self._respond(send, 400, {"error": "send a JSON object or a form"})
+        receiver, text = fields.get("receiver"), fields.get("message")
+        if not isinstance(receiver, str) or not isinstance(text, str) or not receiver or not text:
+            return await self._respond(send, 400, {"error": "Both receiver and message are required"})
+        loop = asyncio.get_running_loop()
+        message = self.new_message(sender, receiver, text)
+        message["id"] = await loop.run_in_executor(None, self.storage.next_id, "messages")
+        stored = loop.create_future()
+        self.pending.append((message, stored))
+        self.wakeup.set()
+        try:
+            await stored
+        except Exception:
+            return await self._respond(send, 503, {"error": "message could not be stored"})
+        await self._respond(send, 201, message)
+
+    async def _writer(self):
+        while True:
+            await self.wakeup.wait()
+            # A short pause lets concurrent sends join the batch
+            await asyncio.sleep(self.flush_interval)
+            await self._flush()
+
+    async def _flush(self):
+        loop = asyncio.get_running_loop()
+        while self.pending:
+            batch, self.pending = self.pending[:self.batch_size], self.pending[self.batch_size:]
+            if not self.pending:
+                self.wakeup.clear()
+            try:
+                await loop.run_in_executor(None, self.storage.insert_many, "messages", [m for m, _ in batch])
+            except Exception as e:
+                for _, stored in batch:
+                    if not stored.done():
+                        stored.set_exception(e)
+                continue
+            for message, stored in batch:
+                for user in {message["sender"], message["receiver"]}:
+                    self._publish(user, "message", message)
+                if not stored.done():
+                    stored.set_result(None)
+            receivers = {m["receiver"] for m, _ in batch}
+            await loop.run_in_executor(None, lambda: [self.notifier.bump(r) for r in receivers])
+        self.wakeup.clear()
+
+    # ---- streaming
+    async def _watcher(self):
+        # One loop for every open stream: push unread counts to users whose
+        # notifier sequence moved, whichever process moved it
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.watch_interval)
+            users = list(self.streams)
+            if not users:
+                continue
+            changed = await loop.run_in_executor(None, self._changed, users)
+            for user, seq, unread in changed:
+                self._publish(user, "unread", {"seq": seq, "changed": True, "unread": unread})
+
+    def _changed(self, users):
+        changed = []
+        for user in users:
+            seq = self.notifier.sequence(user)
+            if self.sequences.get(user) != seq:
+                self.sequences[user] = seq
+                changed.append((user, seq, self.unread_index.messages(user)))
+        return changed
+
+    async def _stream(self, scope, receive, send):
+        user = self._user(scope)
+        if user is None:
+            return await self._respond(send, 401, {"error": "login required"})
+        queue = asyncio.Queue(STREAM_QUEUE)
+        self.streams.setdefault(user, set()).add(queue)
+        await send({"type": "http.response.start", "status": 200, "headers": [
+            (b"content-type", b"text/event-stream"),
+            (b"cache-control", b"no-cache"),
+            (b"x-accel-buffering", b"no"),
+        ]})
+        disconnected = asyncio.create_task(self._disconnected(receive))
+        try:
+            await send({"type": "http.response.body", "body": b"retry: 3000\n\n", "more_body": True})
+            while not disconnected.done():
+                getter = asyncio.create_task(queue.get())
+                done, _ = await asyncio.wait({getter, disconnected}, timeout=HEARTBEAT, return_when=asyncio.FIRST_COMPLETED)
+                if getter not in done:
+                    getter.cancel()
+                    chunk = b": ping\n\n"
+                else:
+                    # Everything queued meanwhile goes out in one write
+                    items = [getter.result()]
+                    while not queue.empty():
+                        items.append(queue.get_nowait())
+                    if None in items:
+                        break
+                    chunk = "".join(items).encode("utf-8")
+                if not disconnected.done():
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            if not disconnected.done():
+                await send({"type": "http.response.body", "body": b""})
+        finally:
+            disconnected.cancel()
+            queues = self.streams.get(user)
+            if queues is not None:
+                queues.discard(queue)
+                if not queues:
+                    del self.streams[user]
+                    self.sequences.pop(user, None)
+
+    async def _disconnected(self, receive):
+        while (await receive())["type"] != "http.disconnect":
+            pass
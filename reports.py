@@ -0,0 +1,128 @@
+import threading
+from array import array
+
+try:
+    import numpy as np
+except ImportError:  # grouping falls back to one plain loop over the arrays
+    np = None
+
+# -------------------- Report Dimensions --------------------
+# collection -> dimension -> key of a row. Keys never return None so the
+# labels of one dimension always sort against each other.
+DIMENSIONS = {
+    "expenses": {
+        "project": lambda r: r.get("project_id") or 0,
+        "month": lambda r: (r.get("date") or "")[:7],
+    },
+    "misc_expenses": {
+        "user": lambda r: r.get("user") or "",
+        "paid_by": lambda r: r.get("paid_by") or "",
+        "month": lambda r: (r.get("date") or "")[:7],
+    },
+}
+
+# -------------------- Columnar Tables --------------------
+# A collection as parallel arrays: one float column of amounts and, per
+# dimension, an int column of codes into that dimension's list of labels.
+# Grouping then works on machine arrays instead of one dict per row.
+class Columns:
+    def __init__(self, rows, dimensions):
+        self.amounts = array("d")
+        self.codes = {d: array("q") for d in dimensions}
+        self.labels = {d: [] for d in dimensions}
+        lookup = {d: {} for d in dimensions}
+        for row in rows:
+            self.amounts.append(float(row.get("amount") or 0))
+            for d, key in dimensions.items():
+                value = key(row)
+                code = lookup[d].get(value)
+                if code is None:
+                    code = lookup[d][value] = len(self.labels[d])
+                    self.labels[d].append(value)
+                self.codes[d].append(code)
+
+    def __len__(self):
+        return len(self.amounts)
+
+    def group(self, dims):
+        # Each row's group is one mixed-radix number over the dimension codes
+        sizes = [len(self.labels[d]) for d in dims]
+        if np is not None:
+            combined = np.zeros(len(self), dtype=np.int64)
+            for d, size in zip(dims, sizes):
+                combined = combined * size + np.frombuffer(self.codes[d], dtype=np.int64)
+            n = 1
+            for size in sizes:
+                n *= size
+            counts = np.bincount(combined, minlength=n)
+            totals = np.bincount(combined, weights=np.frombuffer(self.amounts, dtype=np.float64), minlength=n)
+            present = np.nonzero(counts)[0]
+            groups = zip(present.tolist(), counts[present].tolist(), totals[present].tolist())
+        else:
+            counts, totals = {}, {}
+            columns = [self.codes[d] for d in dims]
+            for i, amount in enumerate(self.amounts):
+                code = 0
+                for column, size in zip(columns, sizes):
+                    code = code * size + column[i]
+                counts[code] = counts.get(code, 0) + 1
+                totals[code] = totals.get(code, 0.0) + amount
+            groups = ((code, counts[code], totals[code]) for code in counts)
+        result = []
+        for code, count, total in groups:
+            key = []
+            for d, size in reversed(list(zip(dims, sizes))):
+                code, index = divmod(code, size)
+                key.append(self.labels[d][index])
+            result.append((tuple(reversed(key)), count, total))
+        result.sort(key=lambda g: g[0])
+        return result
+
+# -------------------- Reports --------------------
+# Tables and grouped results are cached against the collection version, so
+# a report is computed once per change to its collection however often it
+# is viewed.
+class Reports:
+    def __init__(self, storage):
+        self.storage = storage
+        self.lock = threading.Lock()
+        self.tables = {}
+        self.results = {}
+        self.builds = 0
+
+    def columns(self, name):
+        version = self.storage.version(name)
+        with self.lock:
+            cached = self.tables.get(name)
+        if cached is not None and cached[0] == version:
+            return cached
+        with self.storage.consistent(name) as version:
+            table = Columns(self.storage.all(name), DIMENSIONS[name])
+        with self.lock:
+            self.tables[name] = (version, table)
+            self.builds += 1
+        return version, table
+
+    def report(self, name, dims):
+        dims = tuple(dims)
+        version, table = self.columns(name)
+        with self.lock:
+            cached = self.results.get((name, dims))
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        rows, running, prefix = [], 0.0, None
+        for key, count, total in table.group(dims):
+            # Running totals restart whenever the leading dimensions change,
+            # e.g. month by month within each project
+            if key[:-1] != prefix:
+                running, prefix = 0.0, key[:-1]
+            running += total
+            rows.append({
+                "key": dict(zip(dims, key)),
+                "count": count,
+                "total": round(total, 2),
+                "running_total": round(running, 2),
+            })
+        with self.lock:
+            self.results[(name, dims)] = (version, rows)
+        return rows
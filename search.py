@@ -0,0 +1,115 @@
+import math
+import re
+from collections import Counter
+
+from indexes import DerivedIndex, _row_id
+from storage import page_rows
+
+# -------------------- Full-Text Search --------------------
+# One inverted index per collection over its free-text fields, kept current
+# by write notifications like every other derived index:
+#   postings: term -> {row id: occurrences}, docs: row id -> (row, length)
+# A query matches rows holding every one of its terms and ranks them by
+# BM25, so a search only touches the postings of the terms it asks for.
+# Archived messages are not in the messages index; search_rows ranks the
+# archived history of one user on demand instead (the "archive" source).
+SEARCH_FIELDS = {
+    "messages": ("message",),
+    "progress": ("update", "instructions"),
+    "expenses": ("description",),
+    "misc_expenses": ("description", "remarks"),
+}
+SEARCH_ORDER = ("score", "id")
+ARCHIVE_SOURCE = "archive"
+TOKEN = re.compile(r"\w+")
+K1 = 1.2
+B = 0.75
+
+
+def tokenize(text):
+    return TOKEN.findall(str(text or "").lower())
+
+
+def empty_state():
+    return {"postings": {}, "docs": {}, "length": 0}
+
+
+def row_terms(fields, row):
+    return Counter(t for f in fields for t in tokenize(row.get(f)))
+
+
+def add_row(state, fields, row):
+    terms = row_terms(fields, row)
+    if not terms:
+        return
+    key = _row_id(row)
+    length = sum(terms.values())
+    state["docs"][key] = (dict(row), length)
+    state["length"] += length
+    for term, count in terms.items():
+        state["postings"].setdefault(term, {})[key] = count
+
+
+def rank(state, query, limit, before=None, allowed=None):
+    # Best matches first as row copies with a "score"; allowed(row) drops
+    # rows the caller may not see before they are ranked
+    terms = set(tokenize(query))
+    if not terms:
+        return []
+    postings = [state["postings"].get(t) for t in terms]
+    if not all(postings):
+        return []
+    postings.sort(key=len)
+    docs, total = state["docs"], len(state["docs"])
+    average = state["length"] / total
+    weights = [math.log(1 + (total - len(p) + 0.5) / (len(p) + 0.5)) for p in postings]
+    results = []
+    for key in postings[0]:
+        if not all(key in p for p in postings[1:]):
+            continue
+        row, length = docs[key]
+        if allowed is not None and not allowed(row):
+            continue
+        norm = K1 * (1 - B + B * length / average)
+        score = sum(w * p[key] * (K1 + 1) / (p[key] + norm) for w, p in zip(weights, postings))
+        results.append({"score": round(score, 6), "id": row.get("id"), "key": key})
+    # Rank on the small entries, copy only the rows of the page
+    return [dict(docs[r["key"]][0], score=r["score"]) for r in page_rows(results, SEARCH_ORDER, limit, before)]
+
+
+def search_rows(rows, fields, query, limit, before=None):
+    # One-off search over rows that have no index; scores are relative to
+    # these rows only
+    state = empty_state()
+    for row in rows:
+        add_row(state, fields, row)
+    return rank(state, query, limit, before)
+
+
+class TextIndex(DerivedIndex):
+    def __init__(self, storage, collection):
+        self.collection = collection
+        self.fields = SEARCH_FIELDS[collection]
+        super().__init__(storage)
+
+    def empty(self):
+        return empty_state()
+
+    def add(self, state, row):
+        add_row(state, self.fields, row)
+
+    def remove(self, state, row):
+        doc = state["docs"].pop(_row_id(row), None)
+        if doc is None:
+            return
+        key = _row_id(row)
+        state["length"] -= doc[1]
+        for term in row_terms(self.fields, doc[0]):
+            postings = state["postings"].get(term)
+            if postings is not None and postings.pop(key, None) is not None and not postings:
+                del state["postings"][term]
+
+    def search(self, query, limit, before=None, allowed=None):
+        state = self.ensure()
+        with self.lock:
+            return rank(state, query, limit, before, allowed)
@@ -0,0 +1,1230 @@
+import hashlib
+import heapq
+import json
+import marshal
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+try:
+    import fcntl
+except ImportError:  # Windows dev server: no cross-process locking
+    fcntl = None
+
+try:
+    import orjson
+except ImportError:  # the standard json module does the compact formats
+    orjson = None
+
+# -------------------- Collections --------------------
+# name -> (sqlite table, columns). The first column is the primary key.
+COLLECTIONS = {
+    "users": ("user", ["username", "password", "role"]),
+    "projects": ("project", ["id", "name", "description", "users", "status"]),
+    "expenses": ("expense", ["id", "project_id", "amount", "description", "date"]),
+    "progress": ("progress", ["id", "project_id", "update", "date", "user", "instructions"]),
+    "messages": ("message", ["id", "sender", "receiver", "message", "timestamp", "read"]),
+    "misc_expenses": ("misc_expense", ["id", "date", "user", "description", "amount", "paid_by", "remarks"]),
+}
+
+# Values assumed for fields that older records do not carry
+DEFAULTS = {
+    "messages": {"read": False},
+    "misc_expenses": {"paid_by": ""},
+    "progress": {"user": ""},
+}
+
+JSON_COLUMNS = {("projects", "users")}
+BOOL_COLUMNS = {("messages", "read")}
+
+# Value used for a missing sort field so keys always compare
+SORT_DEFAULTS = {"id": 0}
+
+
+def primary_key(name):
+    return COLLECTIONS[name][1][0]
+
+
+def split_lookup(key):
+    field, _, op = key.partition("__")
+    return field, op or "eq"
+
+
+def matches(row, where, defaults=None):
+    defaults = defaults or {}
+    for key, value in where.items():
+        field, op = split_lookup(key)
+        have = row.get(field, defaults.get(field))
+        if op == "eq":
+            ok = have == value
+        elif op == "in":
+            ok = have in value
+        elif op == "lt":
+            ok = have is not None and have < value
+        elif op == "iexact":
+            ok = isinstance(have, str) and have.lower() == value.lower()
+        elif op == "icontains":
+            ok = isinstance(have, str) and value.lower() in have.lower()
+        else:
+            raise ValueError(f"Unknown lookup: {key}")
+        if not ok:
+            return False
+    return True
+
+
+def sort_key(row, order_by):
+    return tuple(
+        row[f] if row.get(f) is not None else SORT_DEFAULTS.get(f, "")
+        for f in order_by
+    )
+
+
+def page_rows(rows, order_by, limit, before=None):
+    # Newest first by order_by, only rows whose key sorts below before
+    if before is not None:
+        before = tuple(before)
+        rows = (r for r in rows if sort_key(r, order_by) < before)
+    return heapq.nlargest(limit, rows, key=lambda r: sort_key(r, order_by))
+
+# -------------------- I/O Observers --------------------
+# Callbacks told about every JSON parse and serialization of a collection
+# file as fn(kind, file, seconds, nbytes), kind being "parse" or "serialize".
+# Used by the opt-in profiler; nothing is measured while the list is empty.
+io_observers = []
+
+
+def observe_io(kind, file, started, nbytes):
+    seconds = time.perf_counter() - started
+    for fn in io_observers:
+        fn(kind, file, seconds, nbytes)
+
+# -------------------- Read Cache --------------------
+# Parsed collections are shared between requests, so callers must treat what
+# load() returns as read-only and copy rows before changing them.
+class ReadCache:
+    def __init__(self):
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(file):
+        st = os.stat(file)
+        return (st.st_mtime_ns, st.st_size)
+
+    def load(self, file):
+        key = self._key(file)
+        entry = self._entries.get(file)
+        if entry is not None and entry[0] == key:
+            self.hits += 1
+            return entry[1]
+        started = time.perf_counter()
+        with open(file, "rb") as f:
+            data = decode_rows(f.read())
+        self.misses += 1
+        if io_observers:
+            observe_io("parse", file, started, key[1])
+        self._entries[file] = (key, data)
+        return data
+
+    def store(self, file, data):
+        self._entries[file] = (self._key(file), data)
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = self.misses = 0
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / total if total else 0.0,
+            "files": len(self._entries),
+        }
+
+
+read_cache = ReadCache()
+
+# -------------------- File Formats --------------------
+# How a collection file is written (STORAGE_FORMAT):
+#   json     indented JSON, the original readable format
+#   compact  JSON without whitespace
+#   jsonl    one JSON row per line
+#   marshal  Python's marshal encoding after a versioned header; fastest to
+#            load and dump, but only readable by the same Python version
+# Reads recognise every format from the content, so a collection stays
+# readable while it is converted. orjson is used for the JSON formats when it
+# is installed.
+FILE_FORMATS = {"json": ".json", "compact": ".json", "jsonl": ".ndjson", "marshal": ".bin"}
+MARSHAL_MAGIC = b"SCROWS"
+MARSHAL_HEADER = MARSHAL_MAGIC + bytes([1, marshal.version])
+
+
+def _json_dumps(value):
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, separators=(",", ":")).encode("utf-8")
+
+
+def _json_loads(data):
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+
+def encode_rows(rows, fmt):
+    if fmt == "json":
+        return json.dumps(rows, indent=4).encode("utf-8")
+    if fmt == "compact":
+        return _json_dumps(rows)
+    if fmt == "jsonl":
+        return b"".join(_json_dumps(r) + b"\n" for r in rows)
+    if fmt == "marshal":
+        return MARSHAL_HEADER + marshal.dumps(rows)
+    raise ValueError(f"Unknown storage format: {fmt}")
+
+
+def decode_rows(data):
+    if data.startswith(MARSHAL_MAGIC):
+        if data[:len(MARSHAL_HEADER)] != MARSHAL_HEADER:
+            raise ValueError(
+                "collection written by another marshal version; convert it to json "
+                "with the Python that wrote it (flask convert-storage json)"
+            )
+        return marshal.loads(data[len(MARSHAL_HEADER):])
+    stripped = data.lstrip()
+    if not stripped or stripped.startswith(b"["):
+        return _json_loads(stripped) if stripped else []
+    return [_json_loads(line) for line in data.splitlines() if line.strip()]
+
+
+def file_format(file):
+    # Format a collection file is in, from its first bytes
+    with open(file, "rb") as f:
+        head = f.read(len(MARSHAL_HEADER))
+    if head.startswith(MARSHAL_MAGIC):
+        return "marshal"
+    if not head.startswith(b"["):
+        return "jsonl" if head.strip() else "json"
+    return "json" if head[1:2].isspace() or head == b"[]" else "compact"
+
+
+def read_rows(file):
+    return [dict(r) for r in read_cache.load(file)]
+
+
+def replace_file(file, write, binary=False):
+    # Write a sibling temp file and rename it over the original so readers
+    # only ever see the old or the new version, never a half-written file.
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(file), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb" if binary else "w") as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, file)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+def write_rows(file, rows, fmt):
+    started = time.perf_counter()
+    data = encode_rows(rows, fmt)
+    replace_file(file, lambda f: f.write(data), binary=True)
+    read_cache.store(file, rows)
+    if io_observers:
+        observe_io("serialize", file, started, len(data))
+
+
+@contextmanager
+def file_lock(path, shared=False):
+    with open(path + ".lock", "a") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+# -------------------- Change Events --------------------
+# Every write is described by an event so the same change can be applied to
+# an in-memory collection and, for log collections, appended to disk.
+# apply_event() returns the affected rows as (old, new) pairs, or None when
+# the whole collection was replaced.
+def apply_event(rows, event, defaults=None):
+    op = event["op"]
+    if op == "insert":
+        rows.append(event["record"])
+        return [(None, event["record"])]
+    if op == "insert_many":
+        rows.extend(event["records"])
+        return [(None, r) for r in event["records"]]
+    if op == "update":
+        changed = []
+        for r in rows:
+            if matches(r, event["where"], defaults):
+                old = dict(r)
+                r.update(event["changes"])
+                changed.append((old, r))
+        return changed
+    if op == "delete":
+        kept, removed = [], []
+        for r in rows:
+            (removed if matches(r, event["where"], defaults) else kept).append(r)
+        rows[:] = kept
+        return [(r, None) for r in removed]
+    if op == "replace":
+        rows[:] = event["rows"]
+        return None
+    raise ValueError(f"Unknown event: {op}")
+
+# -------------------- ID Sequences --------------------
+# IDs come from a persistent per-collection sequence rather than the size of
+# the collection, so a delete never lets an ID come round again. Each process
+# reserves a block of IDs at a time and hands them out from memory; a block
+# left unused when a worker exits only leaves a gap.
+ID_BLOCK_SIZE = int(os.environ.get("ID_BLOCK_SIZE", "20"))
+
+
+class IdBlocks:
+    def __init__(self, reserve, size=ID_BLOCK_SIZE):
+        # reserve(name, count) -> first ID of a fresh block of count IDs
+        self.reserve = reserve
+        self.size = size
+        self.lock = threading.Lock()
+        self.blocks = {}
+        self.pid = os.getpid()
+
+    def next(self, name):
+        with self.lock:
+            if self.pid != os.getpid():
+                # Blocks reserved before a fork belong to the parent
+                self.blocks, self.pid = {}, os.getpid()
+            start, end = self.blocks.get(name, (0, 0))
+            if start >= end:
+                start = self.reserve(name, self.size)
+                end = start + self.size
+            self.blocks[name] = (start + 1, end)
+            return start
+
+    def reset(self, name):
+        with self.lock:
+            self.blocks.pop(name, None)
+
+
+def max_id(rows):
+    return max((r["id"] for r in rows if isinstance(r.get("id"), int)), default=0)
+
+
+def duplicate_ids(rows):
+    # Positions of records without an ID or whose ID an earlier record uses
+    seen, dupes = set(), []
+    for i, r in enumerate(rows):
+        if r.get("id") is None or r["id"] in seen:
+            dupes.append(i)
+        seen.add(r.get("id"))
+    return dupes
+
+# -------------------- Change Notifications --------------------
+# Derived data (indexes, counters) registers with watch() and is told about
+# every change made through this process, including log events replayed from
+# other workers. Each call carries the collection version before and after
+# the change so a watcher can tell whether it missed something.
+class Storage:
+    def __init__(self):
+        self._watchers = {}
+        self._ids = IdBlocks(self._reserve)
+
+    def watch(self, name, fn):
+        self._watchers.setdefault(name, []).append(fn)
+
+    def _notify(self, name, changes, before, after):
+        for fn in self._watchers.get(name, ()):
+            fn(changes, before, after)
+
+    def changes(self, name, since):
+        # Writes made after version `since` by any process, as (changes,
+        # before, after) oldest first, for watchers to catch up on; None
+        # when the storage keeps no such record and they have to rebuild
+        return None
+
+    def get(self, name, **where):
+        return next(iter(self.find(name, **where)), None)
+
+    def next_id(self, name):
+        return self._ids.next(name)
+
+    def next_ids(self, name, count):
+        # A dedicated range for bulk inserts, outside the per-process block
+        start = self._reserve(name, count)
+        return range(start, start + count)
+
+    def _numbered(self, name, records):
+        records = list(records)
+        if primary_key(name) != "id":
+            return records
+        ids = iter(self.next_ids(name, sum(1 for r in records if r.get("id") is None)))
+        return [r if r.get("id") is not None else {"id": next(ids), **r} for r in records]
+
+    def _reserve(self, name, count, floor=0):
+        # Moves the stored sequence past count IDs (and at least to floor),
+        # returning the first one
+        raise NotImplementedError
+
+    def _reseed(self, name, rows):
+        # After a bulk replace: never hand out an ID the new rows already use
+        if primary_key(name) == "id":
+            self._reserve(name, 0, floor=max_id(rows) + 1)
+            self._ids.reset(name)
+
+# -------------------- Append-only Log --------------------
+# A log collection is a JSON snapshot plus a JSON Lines file of events written
+# since the snapshot was taken. Writes append one line per event instead of
+# rewriting the snapshot; compact() folds the log back into the snapshot.
+# Lock order is always file lock, then self.lock.
+#
+# compact() writes the snapshot and then empties the log, two separate
+# renames. Before either it records in <log>.fold which log (inode and
+# length) the new snapshot folds in and a hash of the snapshot, so a process
+# that stopped in between leaves a snapshot that loading recognises, and
+# the log bytes it already holds are skipped instead of replayed twice.
+COMPACT_EVERY = int(os.environ.get("LOG_COMPACT_EVERY", "1000"))
+
+
+class AppendLog:
+    def __init__(self, snapshot_path, log_path, defaults=None, on_change=None, fmt="json"):
+        self.snapshot_path = snapshot_path
+        self.log_path = log_path
+        self.fold_path = log_path + ".fold"
+        self.format = fmt
+        self.defaults = defaults
+        self.on_change = on_change
+        self.lock = threading.Lock()
+        self.rows = None
+        self.snapshot_key = None
+        self.log_ino = None
+        self.offset = 0
+        self.events = 0
+
+    def _fresh(self):
+        try:
+            log = os.stat(self.log_path)
+        except FileNotFoundError:
+            return False
+        return (
+            self.rows is not None
+            and ReadCache._key(self.snapshot_path) == self.snapshot_key
+            and log.st_ino == self.log_ino
+            and log.st_size == self.offset
+        )
+
+    def current(self):
+        # Lock-free when nothing was written since the last refresh
+        if self._fresh():
+            return self.rows
+        with file_lock(self.snapshot_path, shared=True), self.lock:
+            return self.refresh()
+
+    def refresh(self):
+        # Caller holds the file lock and self.lock
+        if not os.path.exists(self.log_path):
+            replace_file(self.log_path, lambda f: None)
+        snapshot_key = ReadCache._key(self.snapshot_path)
+        log = os.stat(self.log_path)
+        if (
+            self.rows is None
+            or snapshot_key != self.snapshot_key
+            or log.st_ino != self.log_ino
+            or log.st_size < self.offset
+        ):
+            started = time.perf_counter()
+            with open(self.snapshot_path, "rb") as f:
+                data = f.read()
+            self.rows = decode_rows(data)
+            read_cache.misses += 1
+            if io_observers:
+                observe_io("parse", self.snapshot_path, started, snapshot_key[1])
+            self.snapshot_key = snapshot_key
+            self.log_ino = log.st_ino
+            self.offset = self._folded(data, log)
+            self.events = 0
+        if log.st_size > self.offset:
+            started = time.perf_counter()
+            with open(self.log_path, "rb") as f:
+                f.seek(self.offset)
+                tail = f.read()
+            # A trailing line without a newline is a torn write; skip it
+            end = tail.rfind(b"\n") + 1
+            for line in tail[:end].splitlines(keepends=True):
+                before = self.version
+                self.offset += len(line)
+                if line.strip():
+                    changes = apply_event(self.rows, json.loads(line), self.defaults)
+                    self.events += 1
+                    if self.on_change is not None:
+                        self.on_change(changes, before, self.version)
+            if io_observers:
+                observe_io("parse", self.log_path, started, end)
+        return self.rows
+
+    def _folded(self, snapshot, log):
+        # Log bytes the snapshot already holds: all zero unless a compact()
+        # stopped after writing the snapshot and before emptying the log
+        try:
+            with open(self.fold_path, "r") as f:
+                fold = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return 0
+        if fold["log_ino"] != log.st_ino or fold["sha1"] != hashlib.sha1(snapshot).hexdigest():
+            return 0
+        return min(fold["offset"], log.st_size)
+
+    @property
+    def version(self):
+        return (self.snapshot_key, self.log_ino, self.offset)
+
+    def append(self, events):
+        # Caller holds the exclusive file lock and self.lock, after refresh()
+        started = time.perf_counter()
+        if os.path.getsize(self.log_path) > self.offset:
+            os.truncate(self.log_path, self.offset)
+        data = "".join(json.dumps(e, separators=(",", ":")) + "\n" for e in events).encode()
+        with open(self.log_path, "ab") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        if io_observers:
+            observe_io("serialize", self.log_path, started, len(data))
+        self.offset += len(data)
+        self.events += len(events)
+        if self.events >= COMPACT_EVERY:
+            self.compact()
+
+    def compact(self):
+        # Caller holds the exclusive file lock and self.lock, after refresh()
+        started = time.perf_counter()
+        data = encode_rows(self.rows, self.format)
+        fold = {"log_ino": self.log_ino, "offset": self.offset, "sha1": hashlib.sha1(data).hexdigest()}
+        replace_file(self.fold_path, lambda f: json.dump(fold, f))
+        replace_file(self.snapshot_path, lambda f: f.write(data), binary=True)
+        if io_observers:
+            observe_io("serialize", self.snapshot_path, started, len(data))
+        replace_file(self.log_path, lambda f: None)
+        os.unlink(self.fold_path)
+        self.snapshot_key = ReadCache._key(self.snapshot_path)
+        self.log_ino = os.stat(self.log_path).st_ino
+        self.offset = 0
+        self.events = 0
+
+# -------------------- Group Commit --------------------
+# Writers queue a mutation and the first one to get the collection lock applies
+# every queued mutation to a single fresh copy of the collection, writes it
+# once and wakes the others. Writes that arrive while a commit is in flight
+# therefore share the next read/write/fsync instead of each doing their own.
+class PendingWrite:
+    def __init__(self, fn):
+        self.fn = fn
+        self.done = False
+        self.result = None
+        self.error = None
+
+
+class WriteGroup:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queue_lock = threading.Lock()
+        self.queue = []
+        self.commits = 0
+        self.writes = 0
+
+# -------------------- JSON Backend --------------------
+# Collections stored as a snapshot plus an append-only event log
+LOG_COLLECTIONS = {"messages"}
+
+
+class JsonStorage(Storage):
+    def __init__(self, data_dir, fmt="json"):
+        super().__init__()
+        if fmt not in FILE_FORMATS:
+            raise ValueError(f"Unknown storage format: {fmt}")
+        self.data_dir = data_dir
+        self.format = fmt
+        self.converted = []
+        self._prepared = set()
+        self._prepare_lock = threading.Lock()
+        self._groups = {name: WriteGroup() for name in COLLECTIONS}
+        self._logs = {
+            name: AppendLog(
+                self.path(name),
+                self.log_path(name),
+                DEFAULTS.get(name),
+                on_change=lambda changes, before, after, name=name: self._notify(name, changes, before, after),
+                fmt=fmt,
+            )
+            for name in LOG_COLLECTIONS
+        }
+
+    def prepare(self, names=COLLECTIONS):
+        # Collections are prepared on first use; this does it up front
+        for name in names:
+            self._prepare(name)
+        return self.converted
+
+    def _prepare(self, name):
+        # First use in this process: create or convert the collection file
+        # and replay whatever the log holds past the snapshot
+        if name in self._prepared:
+            return
+        with self._prepare_lock:
+            if name in self._prepared:
+                return
+            os.makedirs(self.data_dir, exist_ok=True)
+            with file_lock(self.path(name)):
+                self._convert(name)
+                if name in self._logs:
+                    with self._logs[name].lock:
+                        self._logs[name].refresh()
+            self._prepared.add(name)
+
+    def _convert(self, name):
+        # Caller holds the file lock of path(name). Rewrites a collection
+        # found in another format into the configured one; the event log of
+        # a log collection does not depend on the format and stays as it is.
+        path = self.path(name)
+        if os.path.exists(path):
+            source = path
+        else:
+            others = (os.path.join(self.data_dir, name + ext) for ext in set(FILE_FORMATS.values()))
+            source = next((f for f in others if os.path.exists(f)), None)
+        if source is None:
+            write_rows(path, [], self.format)
+            return
+        current = file_format(source)
+        if current == self.format:
+            return
+        with file_lock(source) if source != path else nullcontext():
+            with open(source, "rb") as f:
+                rows = decode_rows(f.read())
+            if not rows and source == path:
+                # An empty collection reads the same in every format
+                return
+            write_rows(path, rows, self.format)
+            if source != path:
+                os.unlink(source)
+        self.converted.append((name, current, self.format))
+
+    def path(self, name):
+        return os.path.join(self.data_dir, name + FILE_FORMATS[self.format])
+
+    def log_path(self, name):
+        return os.path.join(self.data_dir, f"{name}.jsonl")
+
+    def _reserve(self, name, count, floor=0):
+        self._prepare(name)
+        path = os.path.join(self.data_dir, "sequences.json")
+        with file_lock(path):
+            try:
+                with open(path, "r") as f:
+                    sequences = json.load(f)
+            except FileNotFoundError:
+                sequences = {}
+            if name not in sequences:
+                # First use: continue after the highest ID already stored
+                sequences[name] = max_id(self._rows(name)) + 1
+            start = max(sequences[name], floor)
+            sequences[name] = start + count
+            replace_file(path, lambda f: json.dump(sequences, f, indent=4))
+        return start
+
+    def _rows(self, name):
+        # Shared parsed rows; never hand these out without copying
+        self._prepare(name)
+        if name in self._logs:
+            return self._logs[name].current()
+        return read_cache.load(self.path(name))
+
+    def version(self, name):
+        self._prepare(name)
+        if name in self._logs:
+            self._logs[name].current()
+            return self._logs[name].version
+        return ReadCache._key(self.path(name))
+
+    @contextmanager
+    def consistent(self, name):
+        # Holds off writers from this and other processes while derived data
+        # is rebuilt; yields the version the reads will reflect.
+        self._prepare(name)
+        with self._groups[name].lock, file_lock(self.path(name), shared=True):
+            if name in self._logs:
+                log = self._logs[name]
+                with log.lock:
+                    log.refresh()
+                yield log.version
+            else:
+                yield ReadCache._key(self.path(name))
+
+    def all(self, name):
+        return [dict(r) for r in self._rows(name)]
+
+    def find(self, name, **where):
+        defaults = DEFAULTS.get(name)
+        return [dict(r) for r in self._rows(name) if matches(r, where, defaults)]
+
+    def count(self, name, **where):
+        defaults = DEFAULTS.get(name)
+        return sum(1 for r in self._rows(name) if matches(r, where, defaults))
+
+    def scan(self, name, **where):
+        # Generator over matching rows, one copy at a time
+        defaults = DEFAULTS.get(name)
+        for r in self._rows(name):
+            if matches(r, where, defaults):
+                yield dict(r)
+
+    def page(self, name, order_by, limit, before=None, **where):
+        defaults = DEFAULTS.get(name)
+        candidates = (r for r in self._rows(name) if matches(r, where, defaults))
+        return [dict(r) for r in page_rows(candidates, order_by, limit, before)]
+
+    def distinct(self, name, field, **where):
+        defaults = DEFAULTS.get(name)
+        return {r[field] for r in self._rows(name) if r.get(field) is not None and matches(r, where, defaults)}
+
+    def total(self, name, field, **where):
+        defaults = DEFAULTS.get(name)
+        return sum(float(r.get(field) or 0) for r in self._rows(name) if matches(r, where, defaults))
+
+    def _commit(self, name, fn):
+        # fn(rows) returns the event describing the change to make
+        group = self._groups[name]
+        pending = PendingWrite(fn)
+        with group.queue_lock:
+            group.queue.append(pending)
+        with group.lock:
+            if not pending.done:
+                with group.queue_lock:
+                    batch, group.queue = group.queue, []
+                self._apply(name, batch)
+                group.commits += 1
+                group.writes += len(batch)
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def _run(self, name, batch, rows):
+        events, changes = [], []
+        for pending in batch:
+            try:
+                event = pending.fn(rows)
+                applied = apply_event(rows, event, DEFAULTS.get(name))
+            except Exception as e:
+                pending.error = e
+                continue
+            if applied is None:
+                pending.result = len(rows)
+                changes = None
+            elif event["op"] == "insert":
+                pending.result = event["record"]
+            else:
+                pending.result = len(applied)
+            if applied != []:
+                events.append(event)
+                if changes is not None and applied is not None:
+                    changes.extend(applied)
+        return events, changes
+
+    def _apply(self, name, batch):
+        path = self.path(name)
+        try:
+            self._prepare(name)
+            with file_lock(path):
+                if name in self._logs:
+                    log = self._logs[name]
+                    with log.lock:
+                        log.refresh()
+                        before = log.version
+                        try:
+                            events, changes = self._run(name, batch, log.rows)
+                            if any(e["op"] == "replace" for e in events):
+                                log.compact()
+                            elif events:
+                                log.append(events)
+                        except Exception:
+                            # The events are already applied to log.rows; a
+                            # write that failed must not stay in memory for a
+                            # later compact() to store, so reload from disk
+                            log.rows = None
+                            raise
+                        after = log.version
+                else:
+                    before = ReadCache._key(path)
+                    rows = read_rows(path)
+                    events, changes = self._run(name, batch, rows)
+                    if events:
+                        write_rows(path, rows, self.format)
+                    after = ReadCache._key(path)
+                if events:
+                    self._notify(name, changes, before, after)
+        except Exception as e:
+            for pending in batch:
+                pending.error = pending.error or e
+        finally:
+            for pending in batch:
+                pending.done = True
+
+    def insert(self, name, record):
+        if primary_key(name) == "id" and record.get("id") is None:
+            record = {"id": self.next_id(name), **record}
+        return self._commit(name, lambda rows: {"op": "insert", "record": record})
+
+    def insert_many(self, name, records):
+        # One commit (one file rewrite or one log append) for the whole batch
+        records = self._numbered(name, records)
+        if not records:
+            return 0
+        return self._commit(name, lambda rows: {"op": "insert_many", "records": records})
+
+    def bulk_insert(self, name, records, count):
+        # The collection is held in memory anyway, so this is one insert_many:
+        # one file rewrite or one log append
+        return self.insert_many(name, records)
+
+    def update(self, name, changes, **where):
+        return self._commit(name, lambda rows: {"op": "update", "where": where, "changes": changes})
+
+    def delete(self, name, **where):
+        return self._commit(name, lambda rows: {"op": "delete", "where": where})
+
+    def replace(self, name, rows):
+        new_rows = list(rows)
+        result = self._commit(name, lambda current: {"op": "replace", "rows": new_rows})
+        self._reseed(name, new_rows)
+        return result
+
+    def fix_duplicate_ids(self, name):
+        # Records written with len(rows) + 1 IDs can share an ID after a
+        # delete, and early messages have none. The first record keeps a
+        # shared ID, later ones and unnumbered ones get fresh IDs; returns
+        # (old, new) ID pairs. New inserts never add duplicates, so the IDs
+        # reserved from a snapshot are enough unless old code is still running.
+        fresh = [self.next_id(name) for _ in duplicate_ids(self._rows(name))]
+        renumbered = []
+
+        def event(rows):
+            new_rows = [dict(r) for r in rows]
+            ids = iter(fresh)
+            renumbered.clear()
+            for i in duplicate_ids(new_rows):
+                new_id = next(ids, None)
+                if new_id is None:
+                    raise RuntimeError(f"{name} changed during the migration, run it again")
+                renumbered.append((new_rows[i].get("id"), new_id))
+                new_rows[i] = {"id": new_id, **{k: v for k, v in new_rows[i].items() if k != "id"}}
+            return {"op": "replace", "rows": new_rows}
+
+        if fresh:
+            self._commit(name, event)
+        return renumbered
+
+    def compact(self, name):
+        self._prepare(name)
+        log = self._logs[name]
+        with file_lock(self.path(name)), log.lock:
+            log.refresh()
+            folded = log.events
+            before = log.version
+            log.compact()
+            # Same rows, new file identity: watchers simply move to the new version
+            self._notify(name, [], before, log.version)
+        return folded
+
+    def write_stats(self):
+        stats = {
+            name: {"writes": g.writes, "commits": g.commits}
+            for name, g in self._groups.items()
+        }
+        for name, log in self._logs.items():
+            stats[name]["log_events"] = log.events
+        return stats
+
+# -------------------- SQLite Backend --------------------
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS user (
+    username VARCHAR NOT NULL, password VARCHAR NOT NULL, role VARCHAR NOT NULL,
+    PRIMARY KEY (username)
+);
+CREATE TABLE IF NOT EXISTS project (
+    id INTEGER NOT NULL, name VARCHAR NOT NULL, description VARCHAR, users VARCHAR, status VARCHAR,
+    PRIMARY KEY (id)
+);
+CREATE TABLE IF NOT EXISTS expense (
+    id INTEGER NOT NULL, project_id INTEGER NOT NULL, amount FLOAT NOT NULL, description VARCHAR,
+    date VARCHAR NOT NULL,
+    PRIMARY KEY (id)
+);
+CREATE TABLE IF NOT EXISTS progress (
+    id INTEGER NOT NULL, project_id INTEGER NOT NULL, "update" VARCHAR NOT NULL, date VARCHAR NOT NULL,
+    user VARCHAR NOT NULL, instructions VARCHAR,
+    PRIMARY KEY (id)
+);
+CREATE TABLE IF NOT EXISTS message (
+    id INTEGER NOT NULL, sender VARCHAR NOT NULL, receiver VARCHAR NOT NULL, message VARCHAR NOT NULL,
+    timestamp VARCHAR, read BOOLEAN,
+    PRIMARY KEY (id)
+);
+CREATE TABLE IF NOT EXISTS misc_expense (
+    id INTEGER NOT NULL, date VARCHAR NOT NULL, user VARCHAR NOT NULL, description VARCHAR NOT NULL,
+    amount FLOAT NOT NULL, paid_by VARCHAR NOT NULL, remarks VARCHAR,
+    PRIMARY KEY (id)
+);
+CREATE INDEX IF NOT EXISTS ix_expense_project ON expense (project_id);
+CREATE INDEX IF NOT EXISTS ix_expense_date ON expense (date);
+CREATE INDEX IF NOT EXISTS ix_progress_project ON progress (project_id);
+CREATE INDEX IF NOT EXISTS ix_progress_date ON progress (date);
+CREATE INDEX IF NOT EXISTS ix_progress_user ON progress (user);
+CREATE INDEX IF NOT EXISTS ix_message_receiver ON message (receiver, read);
+CREATE INDEX IF NOT EXISTS ix_message_pair ON message (sender, receiver, timestamp);
+CREATE INDEX IF NOT EXISTS ix_misc_expense_date ON misc_expense (date);
+CREATE INDEX IF NOT EXISTS ix_misc_expense_user ON misc_expense (user, date);
+CREATE TABLE IF NOT EXISTS collection_version (
+    name VARCHAR NOT NULL, seq INTEGER NOT NULL,
+    PRIMARY KEY (name)
+);
+CREATE TABLE IF NOT EXISTS change_log (
+    name VARCHAR NOT NULL, seq INTEGER NOT NULL, changes VARCHAR,
+    PRIMARY KEY (name, seq)
+);
+CREATE TABLE IF NOT EXISTS id_sequence (
+    name VARCHAR NOT NULL, next INTEGER NOT NULL,
+    PRIMARY KEY (name)
+);
+"""
+
+
+# Every write also records its (old, new) row pairs under the version it
+# creates, so indexes in other processes replay the last CHANGE_LOG_KEEP
+# writes instead of rebuilding from the whole table. Whole-collection writes
+# (replace, bulk_insert) record NULL, which makes them rebuild.
+CHANGE_LOG_KEEP = int(os.environ.get("CHANGE_LOG_KEEP", "1000"))
+
+
+def _quote(column):
+    return f'"{column}"'
+
+
+class SqliteStorage(Storage):
+    def __init__(self, path):
+        super().__init__()
+        self.db_path = path
+        self._local = threading.local()
+        self._ready = False
+        self._prepare_lock = threading.Lock()
+
+    def connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            # Autocommit mode; writes open their own transactions
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        if not self._ready:
+            self._create_schema(conn)
+        return conn
+
+    def _create_schema(self, conn):
+        # Once, with the first connection anything asks for
+        with self._prepare_lock:
+            if not self._ready:
+                conn.executescript(SCHEMA)
+                conn.executemany(
+                    "INSERT OR IGNORE INTO collection_version (name, seq) VALUES (?, 0)",
+                    [(name,) for name in COLLECTIONS],
+                )
+                self._ready = True
+
+    def prepare(self, names=COLLECTIONS):
+        self.connection()
+        return []
+
+    @contextmanager
+    def _transaction(self):
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _bump(self, conn, name, changes):
+        # Called inside a write transaction that changed something
+        before = conn.execute("SELECT seq FROM collection_version WHERE name = ?", (name,)).fetchone()[0]
+        conn.execute("UPDATE collection_version SET seq = ? WHERE name = ?", (before + 1, name))
+        conn.execute(
+            "INSERT INTO change_log (name, seq, changes) VALUES (?, ?, ?)",
+            (name, before + 1, json.dumps(changes, separators=(",", ":")) if changes is not None else None),
+        )
+        conn.execute("DELETE FROM change_log WHERE name = ? AND seq <= ?", (name, before + 1 - CHANGE_LOG_KEEP))
+        return before, before + 1
+
+    def changes(self, name, since):
+        found = []
+        cur = self.connection().execute(
+            "SELECT seq, changes FROM change_log WHERE name = ? AND seq > ? ORDER BY seq", (name, since)
+        )
+        for seq, changes in cur:
+            if seq != since + len(found) + 1 or changes is None:
+                return None
+            found.append(([tuple(pair) for pair in json.loads(changes)], seq - 1, seq))
+        if not found and self.version(name) != since:
+            return None
+        return found
+
+    def version(self, name):
+        return self.connection().execute("SELECT seq FROM collection_version WHERE name = ?", (name,)).fetchone()[0]
+
+    def _reserve(self, name, count, floor=0):
+        table = COLLECTIONS[name][0]
+        with self._transaction() as conn:
+            row = conn.execute("SELECT next FROM id_sequence WHERE name = ?", (name,)).fetchone()
+            if row is None:
+                # First use: continue after the highest ID already stored
+                start = conn.execute(f"SELECT COALESCE(MAX(id), 0) + 1 FROM {table}").fetchone()[0]
+            else:
+                start = row[0]
+            start = max(start, floor)
+            conn.execute("INSERT OR REPLACE INTO id_sequence (name, next) VALUES (?, ?)", (name, start + count))
+        return start
+
+    @contextmanager
+    def consistent(self, name):
+        # A read transaction sees one snapshot of the database (WAL mode)
+        conn = self.connection()
+        conn.execute("BEGIN")
+        try:
+            yield self.version(name)
+        finally:
+            conn.execute("COMMIT")
+
+    def _to_row(self, name, record):
+        columns = COLLECTIONS[name][1]
+        row = {**DEFAULTS.get(name, {}), **record}
+        values = []
+        for column in columns:
+            value = row.get(column)
+            if (name, column) in JSON_COLUMNS and value is not None:
+                value = json.dumps(value)
+            values.append(value)
+        return values
+
+    def _from_row(self, name, row):
+        record = {}
+        for column in row.keys():
+            value = row[column]
+            if value is None:
+                continue
+            if (name, column) in JSON_COLUMNS:
+                value = json.loads(value)
+            elif (name, column) in BOOL_COLUMNS:
+                value = bool(value)
+            record[column] = value
+        return record
+
+    def _where(self, name, where):
+        columns = COLLECTIONS[name][1]
+        clauses, params = [], []
+        for key, value in where.items():
+            field, op = split_lookup(key)
+            if field not in columns:
+                raise ValueError(f"Unknown field for {name}: {field}")
+            column = _quote(field)
+            if field in DEFAULTS.get(name, {}):
+                column = f"COALESCE({column}, ?)"
+                params.append(DEFAULTS[name][field])
+            if op == "eq":
+                clauses.append(f"{column} = ?")
+                params.append(value)
+            elif op == "in":
+                value = list(value)
+                clauses.append(f"{column} IN ({', '.join('?' * len(value))})" if value else "0")
+                params.extend(value)
+            elif op == "lt":
+                clauses.append(f"{column} < ?")
+                params.append(value)
+            elif op == "iexact":
+                clauses.append(f"LOWER({column}) = LOWER(?)")
+                params.append(value)
+            elif op == "icontains":
+                clauses.append(f"INSTR(LOWER({column}), LOWER(?)) > 0")
+                params.append(value)
+            else:
+                raise ValueError(f"Unknown lookup: {key}")
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+    def _select(self, conn, name, where):
+        table = COLLECTIONS[name][0]
+        clause, params = self._where(name, where)
+        cur = conn.execute(f"SELECT * FROM {table}{clause} ORDER BY rowid", params)
+        return [self._from_row(name, r) for r in cur]
+
+    def all(self, name):
+        return self.find(name)
+
+    def find(self, name, **where):
+        return self._select(self.connection(), name, where)
+
+    def scan(self, name, **where):
+        # Own cursor, fetched in chunks, so only a chunk of rows is in memory
+        table = COLLECTIONS[name][0]
+        clause, params = self._where(name, where)
+        cur = self.connection().execute(f"SELECT * FROM {table}{clause} ORDER BY rowid", params)
+        try:
+            while True:
+                chunk = cur.fetchmany(500)
+                if not chunk:
+                    return
+                for r in chunk:
+                    yield self._from_row(name, r)
+        finally:
+            cur.close()
+
+    def count(self, name, **where):
+        table = COLLECTIONS[name][0]
+        clause, params = self._where(name, where)
+        return self.connection().execute(f"SELECT COUNT(*) FROM {table}{clause}", params).fetchone()[0]
+
+    def page(self, name, order_by, limit, before=None, **where):
+        table = COLLECTIONS[name][0]
+        clause, params = self._where(name, where)
+        keys = ", ".join(map(_quote, order_by))
+        if before is not None:
+            clause += (" AND " if clause else " WHERE ") + f"({keys}) < ({', '.join('?' * len(order_by))})"
+            params += list(before)
+        order = ", ".join(f"{_quote(f)} DESC" for f in order_by)
+        cur = self.connection().execute(f"SELECT * FROM {table}{clause} ORDER BY {order} LIMIT ?", params + [limit])
+        return [self._from_row(name, r) for r in cur]
+
+    def distinct(self, name, field, **where):
+        table = COLLECTIONS[name][0]
+        clause, params = self._where(name, where)
+        column = _quote(field)
+        clause += (" AND " if clause else " WHERE ") + f"{column} IS NOT NULL"
+        cur = self.connection().execute(f"SELECT DISTINCT {column} FROM {table}{clause}", params)
+        return {r[0] for r in cur}
+
+    def total(self, name, field, **where):
+        table = COLLECTIONS[name][0]
+        clause, params = self._where(name, where)
+        return self.connection().execute(f"SELECT TOTAL({_quote(field)}) FROM {table}{clause}", params).fetchone()[0]
+
+    def _insert_sql(self, name):
+        table, columns = COLLECTIONS[name]
+        return f"INSERT INTO {table} ({', '.join(map(_quote, columns))}) VALUES ({', '.join('?' * len(columns))})"
+
+    def insert(self, name, record):
+        if primary_key(name) == "id" and record.get("id") is None:
+            record = {"id": self.next_id(name), **record}
+        changes = [(None, record)]
+        with self._transaction() as conn:
+            conn.execute(self._insert_sql(name), self._to_row(name, record))
+            versions = self._bump(conn, name, changes)
+        self._notify(name, changes, *versions)
+        return record
+
+    def insert_many(self, name, records):
+        records = self._numbered(name, records)
+        if not records:
+            return 0
+        changes = [(None, r) for r in records]
+        with self._transaction() as conn:
+            conn.executemany(self._insert_sql(name), (self._to_row(name, r) for r in records))
+            versions = self._bump(conn, name, changes)
+        self._notify(name, changes, *versions)
+        return len(records)
+
+    def bulk_insert(self, name, records, count):
+        # Streams count records (an iterable, e.g. a generator over a file)
+        # into one transaction without holding them; watchers are told the
+        # collection changed as a whole and rebuild from it
+        if primary_key(name) == "id":
+            ids = iter(self.next_ids(name, count))
+            records = ({"id": next(ids), **r} for r in records)
+        with self._transaction() as conn:
+            inserted = conn.executemany(self._insert_sql(name), (self._to_row(name, r) for r in records)).rowcount
+            versions = self._bump(conn, name, None)
+        self._notify(name, None, *versions)
+        return inserted
+
+    def update(self, name, changes, **where):
+        table, columns = COLLECTIONS[name]
+        sets, params = [], []
+        for column, value in changes.items():
+            if column not in columns:
+                raise ValueError(f"Unknown field for {name}: {column}")
+            if (name, column) in JSON_COLUMNS:
+                value = json.dumps(value)
+            sets.append(f"{_quote(column)} = ?")
+            params.append(value)
+        clause, where_params = self._where(name, where)
+        with self._transaction() as conn:
+            old = self._select(conn, name, where)
+            if old:
+                changed = [(r, {**r, **changes}) for r in old]
+                conn.execute(f"UPDATE {table} SET {', '.join(sets)}{clause}", params + where_params)
+                versions = self._bump(conn, name, changed)
+        if old:
+            self._notify(name, changed, *versions)
+        return len(old)
+
+    def delete(self, name, **where):
+        table = COLLECTIONS[name][0]
+        clause, params = self._where(name, where)
+        with self._transaction() as conn:
+            old = self._select(conn, name, where)
+            if old:
+                changed = [(r, None) for r in old]
+                conn.execute(f"DELETE FROM {table}{clause}", params)
+                versions = self._bump(conn, name, changed)
+        if old:
+            self._notify(name, changed, *versions)
+        return len(old)
+
+    def replace(self, name, rows):
+        table = COLLECTIONS[name][0]
+        rows = list(rows)
+        with self._transaction() as conn:
+            conn.execute(f"DELETE FROM {table}")
+            conn.executemany(self._insert_sql(name), (self._to_row(name, r) for r in rows))
+            versions = self._bump(conn, name, None)
+        self._notify(name, None, *versions)
+        self._reseed(name, rows)
+
+    def _reseed(self, name, rows):
+        # Rows imported without an ID were numbered by SQLite, so ask the table
+        if primary_key(name) == "id":
+            table = COLLECTIONS[name][0]
+            top = self.connection().execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}").fetchone()[0]
+            self._reserve(name, 0, floor=top + 1)
+            self._ids.reset(name)
+
+    def fix_duplicate_ids(self, name):
+        # The primary key constraint already rules out duplicates
+        return []
+
+
+def open_storage(backend, data_dir, db_path, fmt="json"):
+    if backend == "sqlite":
+        return SqliteStorage(db_path)
+    if backend == "json":
+        return JsonStorage(data_dir, fmt)
+    raise ValueError(f"Unknown storage backend: {backend}")
@@ -0,0 +1,34 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import AppendLog, JsonStorage  # noqa: E402
+
+# -------------------- Failed Log Writes --------------------
+# A write whose log append fails is reported to the caller and must leave no
+# trace: not in this process, not in another, and not after a compaction.
+
+
+def message(text):
+    return {"sender": "a", "receiver": "b", "message": text, "read": False}
+
+
+def test_failed_append_is_not_kept(tmp_path, monkeypatch):
+    storage = JsonStorage(str(tmp_path))
+    storage.insert("messages", message("kept"))
+    append = AppendLog.append
+
+    def failing(self, events):
+        monkeypatch.setattr(AppendLog, "append", append)
+        raise OSError(28, "No space left on device")
+
+    monkeypatch.setattr(AppendLog, "append", failing)
+    with pytest.raises(OSError):
+        storage.insert("messages", message("lost"))
+
+    assert [m["message"] for m in storage.all("messages")] == ["kept"]
+    storage.compact("messages")
+    assert [m["message"] for m in JsonStorage(str(tmp_path)).all("messages")] == ["kept"]
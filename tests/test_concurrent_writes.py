@@ -0,0 +1,69 @@
+import multiprocessing
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import open_storage  # noqa: E402
+
+# -------------------- Concurrent Writers --------------------
+# PROCESSES workers (like gunicorn's) with THREADS threads each insert into
+# one collection at the same time, each through its own storage; every row
+# must be there afterwards, under an ID no other row has.
+PROCESSES = int(os.environ.get("STRESS_PROCESSES", "6"))
+THREADS = int(os.environ.get("STRESS_THREADS", "4"))
+ROWS = int(os.environ.get("STRESS_ROWS", "40"))
+
+
+def record(name, worker, thread, i):
+    if name == "messages":
+        return {"sender": f"w{worker}", "receiver": f"t{thread}", "message": str(i), "read": False}
+    return {"project_id": worker, "amount": i, "description": f"t{thread}", "date": "2025-01-01"}
+
+
+def writer(backend, data_dir, db_path, name, worker, start):
+    storage = open_storage(backend, data_dir, db_path)
+    start.wait()
+
+    def insert(thread):
+        for i in range(ROWS):
+            storage.insert(name, record(name, worker, thread, i))
+
+    threads = [threading.Thread(target=insert, args=(t,)) for t in range(THREADS)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+@pytest.mark.parametrize("backend", ["json", "sqlite"])
+@pytest.mark.parametrize("name", ["expenses", "messages"])
+def test_no_write_is_lost(tmp_path, backend, name):
+    data_dir, db_path = str(tmp_path / "data"), str(tmp_path / "db.sqlite")
+    # Create the collections before the writers race for them
+    open_storage(backend, data_dir, db_path).prepare()
+    context = multiprocessing.get_context("fork")
+    start = context.Event()
+    workers = [
+        context.Process(target=writer, args=(backend, data_dir, db_path, name, w, start))
+        for w in range(PROCESSES)
+    ]
+    for p in workers:
+        p.start()
+    start.set()
+    for p in workers:
+        p.join(timeout=120)
+    assert [p.exitcode for p in workers] == [0] * PROCESSES
+
+    rows = open_storage(backend, data_dir, db_path).all(name)
+    expected = PROCESSES * THREADS * ROWS
+    assert len(rows) == expected
+    assert len({r["id"] for r in rows}) == expected
+    if name == "messages":
+        seen = {(r["sender"], r["receiver"], r["message"]) for r in rows}
+    else:
+        seen = {(r["project_id"], r["description"], r["amount"]) for r in rows}
+    assert len(seen) == expected
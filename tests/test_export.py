@@ -0,0 +1,41 @@
+import csv
+import io
+import json
+import os
+import shutil
+import sys
+
+import pytest
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+from app import create_app  # noqa: E402
+
+# -------------------- Export Streams --------------------
+# An export is streamed after the view has returned, so it must be read to
+# the end to show that the rows still reach storage.
+
+
+@pytest.fixture
+def client(tmp_path):
+    data_dir = str(tmp_path / "data")
+    shutil.copytree(os.path.join(BASE_DIR, "data"), data_dir)
+    app = create_app({"DATA_DIR": data_dir, "STORAGE_BACKEND": "json", "PROFILE": False, "PRELOAD": False})
+    client = app.test_client()
+    client.post("/", data={"username": "admin", "password": "admin123"})
+    return client, app.extensions["softcentric"].storage
+
+
+@pytest.mark.parametrize("fmt", ["csv", "jsonl"])
+def test_export_streams_every_row(client, fmt):
+    client, storage = client
+    response = client.get(f"/export/expenses.{fmt}", buffered=False)
+    assert response.status_code == 200
+    body = b"".join(response.response).decode("utf-8")
+    response.close()
+    if fmt == "csv":
+        rows = list(csv.DictReader(io.StringIO(body)))
+    else:
+        rows = [json.loads(line) for line in body.splitlines()]
+    assert len(rows) == len(storage.all("expenses"))
@@ -0,0 +1,175 @@
+import csv
+import io
+import json
+from datetime import datetime
+
+from storage import COLLECTIONS
+
+# -------------------- Export --------------------
+# Exports are generators so a response streams one row at a time and never
+# holds the whole collection as text.
+TRANSFER_COLLECTIONS = ("expenses", "progress", "messages", "misc_expenses")
+FORMATS = {"csv": "text/csv", "jsonl": "application/x-ndjson"}
+
+
+def export_rows(storage, name, fmt):
+    rows = storage.scan(name)
+    if fmt == "jsonl":
+        for row in rows:
+            yield json.dumps(row, separators=(",", ":")) + "\n"
+        return
+    columns = COLLECTIONS[name][1]
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=columns, extrasaction="ignore")
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+# -------------------- Import --------------------
+# Every row is checked before anything is written, so a bad file changes
+# nothing; a valid file then goes in as a single write (one transaction on
+# SQLite, one commit on the JSON backend), so an import is stored whole or
+# not at all. Imported rows always get fresh IDs.
+MAX_ERRORS = 20
+
+
+def read_rows(f, fmt):
+    # (line number, raw record) pairs from a text stream
+    if fmt == "jsonl":
+        for number, line in enumerate(f, 1):
+            if line.strip():
+                try:
+                    yield number, json.loads(line)
+                except ValueError:
+                    yield number, None
+        return
+    reader = csv.DictReader(f)
+    for raw in reader:
+        yield reader.line_num, raw
+
+
+def _text(raw, field, required=True):
+    value = raw.get(field)
+    value = "" if value is None else str(value).strip()
+    if required and not value:
+        raise ValueError(f"{field} is required")
+    return value
+
+
+def _number(raw, field):
+    try:
+        return float(_text(raw, field))
+    except ValueError:
+        raise ValueError(f"{field} must be a number")
+
+
+def _date(raw, field, fmt="%Y-%m-%d"):
+    value = _text(raw, field)
+    try:
+        datetime.strptime(value, fmt)
+    except ValueError:
+        raise ValueError(f"{field} must look like {datetime(2025, 1, 31).strftime(fmt)}")
+    return value
+
+
+def _timestamp(raw):
+    # Optional; early messages were stored without one
+    value = _text(raw, "timestamp", required=False)
+    if not value:
+        return {}
+    try:
+        datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError("timestamp must look like 2025-01-31 09:30:00")
+    return {"timestamp": value}
+
+
+def _project(raw, project_ids):
+    try:
+        project_id = int(_text(raw, "project_id"))
+    except ValueError:
+        raise ValueError("project_id must be a number")
+    if project_id not in project_ids:
+        raise ValueError(f"no project with id {project_id}")
+    return project_id
+
+
+def _flag(raw, field):
+    value = raw.get(field)
+    if isinstance(value, bool):
+        return value
+    value = "" if value is None else str(value).strip().lower()
+    if value in ("", "0", "false", "no"):
+        return False
+    if value in ("1", "true", "yes"):
+        return True
+    raise ValueError(f"{field} must be true or false")
+
+
+def validate(name, raw, project_ids):
+    if not isinstance(raw, dict):
+        raise ValueError("not a JSON object")
+    if name == "expenses":
+        return {
+            "project_id": _project(raw, project_ids),
+            "amount": _number(raw, "amount"),
+            "description": _text(raw, "description", required=False),
+            "date": _date(raw, "date"),
+        }
+    if name == "progress":
+        return {
+            "project_id": _project(raw, project_ids),
+            "update": _text(raw, "update"),
+            "date": _date(raw, "date"),
+            "user": _text(raw, "user", required=False),
+            "instructions": _text(raw, "instructions", required=False),
+        }
+    if name == "messages":
+        return {
+            "sender": _text(raw, "sender"),
+            "receiver": _text(raw, "receiver"),
+            "message": _text(raw, "message"),
+            "read": _flag(raw, "read"),
+            **_timestamp(raw),
+        }
+    if name == "misc_expenses":
+        return {
+            "date": _date(raw, "date"),
+            "user": _text(raw, "user"),
+            "description": _text(raw, "description"),
+            "amount": _number(raw, "amount"),
+            "paid_by": _text(raw, "paid_by", required=False),
+            "remarks": _text(raw, "remarks", required=False),
+        }
+    raise ValueError(f"{name} cannot be imported")
+
+
+def import_rows(storage, name, open_file, fmt):
+    # open_file() returns a fresh text stream; the file is read twice, once
+    # to validate and once to insert, so SQLite never holds more than a row.
+    # Returns (rows imported, errors).
+    project_ids = {p["id"] for p in storage.all("projects")}
+    errors, count = [], 0
+    try:
+        with open_file() as f:
+            for number, raw in read_rows(f, fmt):
+                try:
+                    validate(name, raw, project_ids)
+                    count += 1
+                except ValueError as e:
+                    errors.append(f"line {number}: {e}")
+                    if len(errors) >= MAX_ERRORS:
+                        break
+    except (csv.Error, UnicodeDecodeError) as e:
+        errors.append(f"unreadable {fmt} file: {e}")
+    if errors:
+        return 0, errors
+    if not count:
+        return 0, []
+    with open_file() as f:
+        rows = (validate(name, raw, project_ids) for _, raw in read_rows(f, fmt))
+        return storage.bulk_insert(name, rows, count), []